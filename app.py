@@ -1,99 +1,78 @@
-from flask import Flask, request, render_template, redirect, url_for, g, session, jsonify, flash
-import bcrypt
-import uuid
-import os
-import time
-import math
-import sqlite3
-from datetime import datetime
-import requests
-from math import radians, cos, sin, asin, sqrt
-from db import DB_NAME, init_db, get_connection
-from config import PAYSTACK_SECRET_KEY, PAYSTACK_PUBLIC_KEY, PAYSTACK_CALLBACK_URL
+import startup
+
+with startup.phase("import flask"):
+    from flask import Flask, request, render_template, redirect, url_for, g, session, jsonify, flash, Response
+    import bcrypt
+
+with startup.phase("import app modules"):
+    import uuid
+    import json
+    import sqlite3
+    from datetime import datetime
+    import db
+    from db import init_db, unit_of_work
+    import archive
+    import taps
+    import events
+    from replica import replica
+    from trip_store import active_trips
+    import tap_guard
+    import fares
+    from fares import calculate_distance_km
+    from money import to_cents, format_rands
+    import secrets
+    from config import load_secret_key, ADMIN_TOKEN
 
 # ------------------------------ APP CONFIG ------------------------------ #
 app = Flask(__name__, template_folder='templates')
-app.secret_key = os.urandom(24)
+app.secret_key = load_secret_key()  # same key in every worker process
 
 # ------------------------------ DB HANDLING ------------------------------ #
 def get_db():
     """Get a database connection (per request)."""
     if 'db' not in g:
-        g.db = sqlite3.connect(DB_NAME)
-        g.db.row_factory = sqlite3.Row
+        g.db = db.connect()
     return g.db
 
+def get_replica_db():
+    """Read-only snapshot connection for reporting and history pages (per request)."""
+    if 'replica_db' not in g:
+        replica.start()
+        g.replica_db = replica.connect()
+    return g.replica_db
+
+@app.after_request
+def add_replica_freshness(response):
+    """Tell clients how stale a replica-served response may be."""
+    if 'replica_db' in g:
+        response.headers['X-Replica-Age'] = f"{replica.age() or 0:.1f}"
+    return response
+
 @app.teardown_appcontext
 def close_db(error):
     """Close the database connection at the end of request."""
-    db = g.pop('db', None)
-    if db:
-        db.close()
+    conn = g.pop('db', None)
+    if conn:
+        conn.close()
+    replica_conn = g.pop('replica_db', None)
+    if replica_conn:
+        replica_conn.close()
 
 # ------------------------------ HELPERS ------------------------------ #
-def calculate_distance_km(lat1, lon1, lat2, lon2):
-    """Calculate distance in kilometers using the Haversine formula."""
-    R = 6371  # Earth radius in km
-    lat1, lon1, lat2, lon2 = map(math.radians, [float(lat1), float(lon1), float(lat2), float(lon2)])
-    dlat = lat2 - lat1
-    dlon = lon2 - lon1
-    a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2)**2
-    c = 2 * math.asin(math.sqrt(a))
-    return R * c
-
-def get_fare(distance_km):
-    """Return fare price based on distance."""
-    if distance_km <= 5:
-        return 12
-    elif distance_km <= 10:
-        return 18
-    return 25
+app.template_filter('rands')(format_rands)
 
 @app.template_filter('datetimeformat')
 def datetimeformat(value, format='full'):
     try:
-        dt = datetime.fromtimestamp(value)
+        if isinstance(value, str):
+            dt = datetime.fromisoformat(value)
+        else:
+            dt = datetime.fromtimestamp(value)
         return dt.strftime('%Y-%m-%d' if format == 'date' else '%Y-%m-%d %H:%M:%S')
     except:
         return "Invalid"
 
 
-# ------------------------------ MAIN ------------------------------ #
-if __name__ == '__main__':
-    init_db()
-    app.run(host='0.0.0.0', port=5000, debug=True)
-
-# ------------------------------ DB HANDLING ------------------------------ #
-def get_db():
-    if 'db' not in g:
-        g.db = sqlite3.connect(DB_NAME)
-        g.db.row_factory = sqlite3.Row
-    return g.db
-
-@app.teardown_appcontext
-def close_db(error):
-    db = g.pop('db', None)
-    if db:
-        db.close()
-
-# ------------------------------ HELPERS ------------------------------ #
-def calculate_distance_km(lat1, lon1, lat2, lon2):
-    R = 6371
-    lat1, lon1, lat2, lon2 = map(math.radians, [float(lat1), float(lon1), float(lat2), float(lon2)])
-    dlat = lat2 - lat1
-    dlon = lon2 - lon1
-    a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2)**2
-    c = 2 * math.asin(math.sqrt(a))
-    return R * c
-
-def get_fare(distance_km):
-    if distance_km <= 5:
-        return 12
-    elif distance_km <= 10:
-        return 18
-    else:
-        return 25
-
 # ------------------------------ ROUTES ------------------------------ #
 # ------------------------------ HOME ------------------------------ #
 @app.route('/')
@@ -125,19 +104,15 @@ def register():
             card_id = f"CARD-{uuid.uuid4().hex[:8].upper()}"
 
             try:
-                # Insert user
-                cursor = conn.execute('''
-                    INSERT INTO users (name, surname, email, dob, password, card_id, balance)
-                    VALUES (?, ?, ?, ?, ?, ?, ?)
-                ''', (name, surname, email, dob, hashed_pw, card_id, 0.0))
-                conn.commit()
-
-                # Get the new user's ID
-                user_id = cursor.lastrowid
+                # User and their virtual card are created together
+                with unit_of_work(conn):
+                    user_id = db.create_user(conn, name, surname, email, dob, hashed_pw, card_id)
+                    db.create_virtual_card(conn, user_id, card_id)
 
                 # Set session
                 session['user_id'] = user_id
                 session['card_id'] = card_id
+                session['user_email'] = email
 
                 # Redirect to dashboard
                 return redirect(url_for('dashboard'))
@@ -157,11 +132,12 @@ def login():
         email = request.form.get('email')
         password = request.form.get('password')
 
-        user = conn.execute("SELECT * FROM users WHERE email = ?", (email,)).fetchone()
+        user = db.get_user_by_email(conn, email)
         if user and bcrypt.checkpw(password.encode(), user['password'].encode()):
             # Set session
             session['user_id'] = user['id']
             session['card_id'] = user['card_id']
+            session['user_email'] = user['email']
 
             # Redirect to dashboard
             return redirect(url_for('dashboard'))
@@ -182,8 +158,7 @@ def dashboard():
     if 'user_id' not in session:
         return redirect(url_for('login'))
 
-    db = get_db()
-    user = db.execute('SELECT * FROM users WHERE id = ?', (session['user_id'],)).fetchone()
+    user = db.get_user_by_id(get_db(), session['user_id'])
 
     if not user:
         session.clear()
@@ -191,14 +166,79 @@ def dashboard():
 
     return render_template('dashboard.html', user=user)
 
+HISTORY_PAGE_SIZE = 50
+
+def _owns_card(card_id):
+    """The logged-in rider's own card, or an admin (Bearer token) looking at any card."""
+    return session.get('card_id') == card_id or _is_admin()
+
 @app.route('/history/<card_id>')
 def trip_history(card_id):
-    conn = get_db()
-    trips = conn.execute(
-        "SELECT * FROM trip_history WHERE card_id = ? ORDER BY start_time DESC",
-        (card_id,)
-    ).fetchall()
-    return render_template('trip_history.html', trips=trips)
+    if not _owns_card(card_id):
+        if 'card_id' not in session:
+            flash("Please login first.", "danger")
+            return redirect(url_for('login'))
+        return "❌ You can only view your own card", 403
+
+    conn = get_replica_db()
+    # (`before`, `before_id`) is a (tap_out_time, id) cursor; older pages read through to the archive
+    before = request.args.get('before')
+    before_id = request.args.get('before_id', type=int)
+    trips = archive.history_page(conn, 'trip_history', card_id, before=before, before_id=before_id,
+                                 limit=HISTORY_PAGE_SIZE)
+    next_cursor = trips[-1] if len(trips) == HISTORY_PAGE_SIZE else None
+    return render_template('trip_history.html', trips=trips, card_id=card_id, next_cursor=next_cursor)
+
+@app.route('/export/<card_id>')
+def export_history(card_id):
+    """Stream a card's trips or transactions (live + archived) as NDJSON."""
+    if not _owns_card(card_id):
+        return jsonify(message="❌ You can only export your own card"), 403 if 'card_id' in session else 401
+
+    table = request.args.get('table', 'trip_history')
+    if table not in archive.ARCHIVED_TABLES:
+        return jsonify(message="❌ Unknown table"), 400
+
+    # The stream outlives the request, so it holds its own replica connection
+    conn = replica.connect()
+
+    def generate():
+        try:
+            for row in archive.iter_history(conn, table, card_id):
+                yield json.dumps(row) + "\n"
+        finally:
+            conn.close()
+
+    response = Response(generate(), mimetype='application/x-ndjson')
+    response.headers['X-Replica-Age'] = f"{replica.age() or 0:.1f}"
+    return response
+
+# ------------------------------ FARE QUOTES ------------------------------ #
+MAX_QUOTE_PAIRS = 1000
+
+@app.route('/fare_quote', methods=['POST'])
+def fare_quote():
+    """Quote many origin/destination pairs (station codes or coordinates) in one call."""
+    data = request.get_json(silent=True) or {}
+    pairs = data.get('pairs')
+    if not isinstance(pairs, list) or not pairs:
+        return jsonify(message="❌ Provide a non-empty 'pairs' list"), 400
+    if len(pairs) > MAX_QUOTE_PAIRS:
+        return jsonify(message=f"❌ At most {MAX_QUOTE_PAIRS} pairs per request"), 400
+    return jsonify(quotes=fares.quote_many(pairs))
+
+@app.route('/fare_quote/matrix')
+def fare_quote_matrix():
+    """Published station-to-station fare matrix; supports If-None-Match."""
+    version = fares.fare_table_version()
+    if version in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = jsonify(fares.fare_matrix(version))
+    response.set_etag(version)
+    response.cache_control.public = True
+    response.cache_control.max_age = 300
+    return response
 
 @app.route('/nfc')
 def nfc_page():
@@ -209,42 +249,19 @@ def nfc_tap():
     data = request.get_json()
     card_id = data.get("card_id")
 
-    if not card_id:
-        return jsonify(message="❌ No card ID provided"), 400
-
-    conn = get_db()
-    user = conn.execute("SELECT * FROM users WHERE card_id = ?", (card_id,)).fetchone()
+    # Drop repeated reads and floods before touching the database
+    rejected = card_id and tap_guard.guard.check(card_id, data.get("device_id") or request.remote_addr)
+    if rejected:
+        return jsonify(message="⏳ Duplicate tap ignored" if rejected == "duplicate" else "⏳ Too many taps, slow down",
+                       reason=rejected), 429
 
-    if not user:
-        return jsonify(message="❌ Card not recognized"), 404
+    payload, status = taps.nfc_tap(get_db(), card_id, data.get("latitude", 0.0), data.get("longitude", 0.0))
+    return jsonify(payload), status
 
-    current_trip = conn.execute("SELECT * FROM trip_sessions WHERE card_id = ?", (card_id,)).fetchone()
-    now = time.time()
-    fare = 12  # Flat rate in Rands
+@app.route('/nfc_tap/stats')
+def nfc_tap_stats():
+    return jsonify(tap_guard.guard.stats())
 
-    if not current_trip:
-        # Tap-in: Start trip
-        conn.execute("INSERT INTO trip_sessions (card_id, start_time) VALUES (?, ?)", (card_id, now))
-        conn.commit()
-        return jsonify(message=f"✅ Tap-In Successful for {user['name']}")
-    else:
-        # Tap-out: Complete trip
-        duration = now - current_trip['start_time']
-
-        if user['balance'] < fare:
-            return jsonify(
-                message=f"❌ Insufficient balance for {user['name']} (R{user['balance']:.2f}). Fare is R{fare:.2f}"
-            ), 400
-
-        new_balance = user['balance'] - fare
-
-        conn.execute("DELETE FROM trip_sessions WHERE card_id = ?", (card_id,))
-        conn.execute("UPDATE users SET balance = ? WHERE card_id = ?", (new_balance, card_id))
-        conn.execute('''
-    INSERT INTO trip_history (card_id, name, start_time, end_time, fare)
-    VALUES (?, ?, ?, ?, ?)
-''', (card_id, user['name'], current_trip['start_time'], now, fare))
-        
 # Secure simulate_nfc route — only shows the logged-in user's card
 @app.route("/simulate_nfc", methods=["GET", "POST"])
 def simulate_nfc():
@@ -267,26 +284,32 @@ def simulate_nfc():
 
     if request.method == "POST":
         # only accept the session's card_id — ignore any client-supplied card_id
-        start_lat = float(request.form.get("start_lat", 0))
-        start_lon = float(request.form.get("start_lon", 0))
-        end_lat = float(request.form.get("end_lat", 0))
-        end_lon = float(request.form.get("end_lon", 0))
+        try:
+            start_lat, start_lon = fares.parse_point(request.form.get("start_lat", 0), request.form.get("start_lon", 0))
+            end_lat, end_lon = fares.parse_point(request.form.get("end_lat", 0), request.form.get("end_lon", 0))
+        except ValueError as e:
+            return render_template("simulate_nfc.html", user_card_id=user["card_id"], user_name=user["full_name"],
+                                   balance=user["balance"], message=f"❌ Invalid location: {e}"), 400
 
         distance_km = calculate_distance_km(start_lat, start_lon, end_lat, end_lon)
-        fare = get_fare(distance_km)
-
-        if user["balance"] >= fare:
-            new_balance = user["balance"] - fare
-            # update balance and create a trip session / trip_history entry
-            conn.execute("UPDATE users SET balance = ? WHERE id = ?", (new_balance, user["id"]))
-            conn.execute(
-                "INSERT INTO trip_history (card_id, name, start_time, end_time, fare) VALUES (?, ?, ?, ?, ?)",
-                (card_id, user["full_name"], time.time(), time.time(), fare)
-            )
-            conn.commit()
-            message = f"✅ Fare deducted: R{fare:.2f}. Distance: {distance_km:.2f} km. New balance: R{new_balance:.2f}"
+        trip = {"card_id": card_id, "start_time": datetime.now().isoformat(),
+                "start_lat": start_lat, "start_lon": start_lon}
+        fare = fares.trip_fare(card_id, trip, end_lat, end_lon)
+
+        # simulated tap in and out: the trip never sits in the active-trip store
+        new_balance = None
+        with unit_of_work(conn):
+            # Checked under the write lock, as in tap_out, so concurrent taps and top-ups are seen
+            balance = db.get_user_by_card(conn, card_id)["balance"]
+            if balance >= fare:
+                new_balance = db.end_trip(conn, trip, end_lat, end_lon, fare, user["id"])
+        if new_balance is not None:
+            fares.record_tap_out(card_id, trip, end_lat, end_lon)
+            events.publish(card_id, events.TAP, action="out", lat=end_lat, lon=end_lon, fare_cents=fare,
+                           balance_cents=new_balance)
+            message = f"✅ Fare deducted: {format_rands(fare)}. Distance: {distance_km:.2f} km. New balance: {format_rands(new_balance)}"
         else:
-            message = f"❌ Insufficient balance (R{user['balance']:.2f}). Fare: R{fare:.2f}"
+            message = f"❌ Insufficient balance ({format_rands(balance)}). Fare: {format_rands(fare)}"
 
         # refresh user row for display
         user = conn.execute("SELECT id, card_id, name || ' ' || surname AS full_name, balance FROM users WHERE card_id = ?", (card_id,)).fetchone()
@@ -311,13 +334,13 @@ def tap_in(card_id):
 
         if not lat or not lon:
             return "❌ Location not provided", 400
+        try:
+            lat, lon = fares.parse_point(lat, lon)
+        except ValueError as e:
+            return f"❌ Invalid location: {e}", 400
 
-        conn.execute('DELETE FROM trip_sessions WHERE card_id = ?', (card_id,))
-        conn.execute(
-            'INSERT INTO trip_sessions (card_id, start_time, start_lat, start_lon) VALUES (?, ?, ?, ?)',
-            (card_id, time.time(), lat, lon)
-        )
-        conn.commit()
+        active_trips.start(card_id, lat, lon)
+        events.publish(card_id, events.TAP, action="in", lat=lat, lon=lon)
 
         return render_template('tap_in_success.html', card_id=card_id, lat=lat, lon=lon)
 
@@ -336,29 +359,30 @@ def tap_out(card_id):
 
         if not lat2 or not lon2:
             return "❌ Location not provided", 400
+        try:
+            lat2, lon2 = fares.parse_point(lat2, lon2)
+        except ValueError as e:
+            return f"❌ Invalid location: {e}", 400
 
-        trip = conn.execute('SELECT * FROM trip_sessions WHERE card_id = ?', (card_id,)).fetchone()
-        if not trip:
-            return "❌ No tap-in found. Please tap in first.", 400
+        with unit_of_work(conn):
+            trip = active_trips.get(card_id)
+            if not trip:
+                return "❌ No tap-in found. Please tap in first.", 400
 
-        user = conn.execute('SELECT * FROM users WHERE card_id = ?', (card_id,)).fetchone()
-        if not user:
-            return "❌ User not found.", 404
+            user = db.get_user_by_card(conn, card_id)
+            if not user:
+                return "❌ User not found.", 404
 
-        distance_km = calculate_distance_km(trip['start_lat'], trip['start_lon'], lat2, lon2)
-        fare = get_fare(distance_km)
+            fare = fares.trip_fare(card_id, trip, lat2, lon2)
 
-        if user['balance'] < fare:
-            return f"❌ Insufficient balance (R{user['balance']:.2f}). Fare is R{fare}", 400
+            if user['balance'] < fare:
+                return f"❌ Insufficient balance ({format_rands(user['balance'])}). Fare is {format_rands(fare)}", 400
 
-        new_balance = user['balance'] - fare
-        conn.execute('DELETE FROM trip_sessions WHERE card_id = ?', (card_id,))
-        conn.execute('UPDATE users SET balance = ? WHERE card_id = ?', (new_balance, card_id))
-        conn.execute('''
-            INSERT INTO trip_history (card_id, name, start_time, end_time, fare)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (card_id, user['name'], trip['start_time'], time.time(), fare))
-        conn.commit()
+            new_balance = db.end_trip(conn, trip, lat2, lon2, fare, user['id'])
+            active_trips.end(card_id, conn)
+        fares.record_tap_out(card_id, trip, lat2, lon2)
+        events.publish(card_id, events.TAP, action="out", lat=lat2, lon=lon2, fare_cents=fare,
+                       balance_cents=new_balance)
 
         return render_template('tap_out_success.html', card_id=card_id, fare=fare, balance=new_balance)
 
@@ -369,38 +393,106 @@ def test_tap_out():
     print("Tap out route hit!")
     return "OK"
 
+# ------------------------------ ADMIN ------------------------------ #
+ADMIN_SEARCH_MAX_LIMIT = 100
+
+def _is_admin():
+    supplied = request.headers.get('Authorization', '')
+    return bool(ADMIN_TOKEN) and secrets.compare_digest(supplied, f"Bearer {ADMIN_TOKEN}")
+
+@app.route('/admin/search')
+def admin_search():
+    """Find riders by partial name, surname, email or card ID (prefix match, newest first)."""
+    if not ADMIN_TOKEN:
+        return jsonify(message="❌ Admin API is disabled"), 404
+    if not _is_admin():
+        return jsonify(message="❌ Unauthorized"), 401
+
+    text = request.args.get('q', '').strip()
+    if not text:
+        return jsonify(message="❌ Provide a search term in 'q'"), 400
+    try:
+        before = request.args.get('before', type=int)
+        limit = max(1, min(int(request.args.get('limit', 20)), ADMIN_SEARCH_MAX_LIMIT))
+    except ValueError:
+        return jsonify(message="❌ 'limit' must be a number"), 400
+
+    rows = db.search_users(get_replica_db(), text, before=before, limit=limit + 1)
+    results = [{"id": row['id'], "card_id": row['card_id'], "name": row['name'], "surname": row['surname'],
+                "email": row['email'], "balance_cents": row['balance']} for row in rows[:limit]]
+    # One extra row tells us whether there is another page
+    next_before = results[-1]["id"] if len(rows) > limit else None
+    return jsonify(results=results, next_before=next_before)
+
+# ------------------------------ LIVE UPDATES ------------------------------ #
+@app.route('/events')
+def event_stream():
+    """Server-sent events for the logged-in card: balance changes, taps and top-ups.
+
+    Each open stream holds one server thread until the page closes (see
+    events.MAX_SUBSCRIBERS).
+    """
+    card_id = session.get('card_id')
+    if not card_id:
+        return "❌ Please login first", 401
+
+    subscriber = events.bus.subscribe(card_id)
+    if subscriber is None:
+        return Response("❌ Too many open streams", status=503, headers={'Retry-After': '30'})
+
+    # Current balance first, so a reconnecting page never shows a stale figure
+    user = db.get_user_by_card(get_db(), card_id)
+    bus = events.bus
+
+    def generate():
+        try:
+            if user:
+                yield events.format_sse({"id": 0, "type": events.BALANCE, "data": {"balance_cents": user['balance']}})
+            while True:
+                pending = subscriber.get()
+                if not pending:
+                    yield ": keepalive\n\n"
+                for event in pending:
+                    yield events.format_sse(event)
+        finally:
+            bus.unsubscribe(subscriber)
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def _publish_topup(card_id, amount, new_balance):
+    events.publish(card_id, events.TOPUP, amount_cents=amount, balance_cents=new_balance)
+
 # ------------------------------ PAYSTACK ------------------------------ #
-PAYSTACK_BASE_URL = 'https://api.paystack.co'
+# `paystack` (and with it `requests`) is only imported when a payment route runs
 
 @app.route('/top_up/<card_id>', methods=['GET', 'POST'])
 def top_up(card_id):
-    conn = get_db()
-    user = conn.execute('SELECT * FROM users WHERE card_id = ?', (card_id,)).fetchone()
+    user = db.get_user_by_card(get_db(), card_id)
 
     if not user:
         return "User not found", 404
 
     if request.method == 'POST':
-        amount = float(request.form.get('amount', 0))
+        try:
+            amount = to_cents(request.form.get('amount', 0))
+        except ArithmeticError:
+            return "❌ Please enter a valid amount", 400
         email = user['email']
 
         if amount <= 0:
             return "❌ Please enter a valid amount", 400
 
-        headers = {
-            'Authorization': f'Bearer {PAYSTACK_SECRET_KEY}',
-            'Content-Type': 'application/json'
-        }
-
         data = {
             'email': email,
-            'amount': int(amount * 100),
+            'amount': amount,  # Paystack takes cents
             'currency': 'ZAR',
             'metadata': {'card_id': card_id},
             'callback_url': 'https://4901-41-150-250-231.ngrok-free.app/payment/callback'
         }
 
-        response = requests.post(f'{PAYSTACK_BASE_URL}/transaction/initialize', json=data, headers=headers)
+        import paystack
+        response = paystack.initialize_transaction(data)
 
         if response.status_code == 200:
             payment_url = response.json()['data']['authorization_url']
@@ -416,8 +508,8 @@ def payment_callback():
     if not reference:
         return "❌ No payment reference provided", 400
 
-    headers = {'Authorization': f'Bearer {PAYSTACK_SECRET_KEY}'}
-    response = requests.get(f'{PAYSTACK_BASE_URL}/transaction/verify/{reference}', headers=headers)
+    import paystack
+    response = paystack.verify_transaction(reference)
 
     if response.status_code == 200:
         data = response.json()['data']
@@ -429,16 +521,17 @@ def payment_callback():
         if data.get('currency') != 'ZAR':
             return "❌ Payment currency mismatch", 400
 
-        amount = data['amount'] / 100  # Convert from kobo/cents to rands
+        amount = int(data['amount'])  # Paystack reports cents
         card_id = data['metadata']['card_id']
 
         conn = get_db()
-        user = conn.execute('SELECT * FROM users WHERE card_id = ?', (card_id,)).fetchone()
+        with unit_of_work(conn):
+            user = db.get_user_by_card(conn, card_id)
+            if user:
+                new_balance = db.update_balance(conn, card_id, amount, 'topup')
 
         if user:
-            new_balance = user['balance'] + amount
-            conn.execute('UPDATE users SET balance = ? WHERE card_id = ?', (new_balance, card_id))
-            conn.commit()
+            _publish_topup(card_id, amount, new_balance)
             return render_template('payment_success.html', card_id=card_id, amount=amount, balance=new_balance)
         else:
             return "❌ User not found", 404
@@ -453,12 +546,11 @@ def verify_payment():
         flash("Payment reference missing", "danger")
         return redirect(url_for('home'))
 
-    headers = {'Authorization': f'Bearer {PAYSTACK_SECRET_KEY}'}
-    
+    import paystack
     try:
-        response = requests.get(f"{PAYSTACK_BASE_URL}/transaction/verify/{reference}", headers=headers, timeout=30)
+        response = paystack.verify_transaction(reference, timeout=30)
         response.raise_for_status()
-    except requests.RequestException as e:
+    except paystack.RequestException as e:
         flash(f"❌ Payment verification failed: {e}", "danger")
         return redirect(url_for('home'))
 
@@ -472,7 +564,7 @@ def verify_payment():
         return redirect(url_for('home'))
 
     # Extract amount and card_id
-    amount = float(data.get("amount", 0)) / 100.0  # convert from cents/kobo to Rands
+    amount = int(data.get("amount", 0))  # Paystack reports cents
     card_id = (data.get("metadata") or {}).get("card_id")
     if not card_id:
         flash("❌ Payment metadata missing card info.", "danger")
@@ -480,21 +572,23 @@ def verify_payment():
 
     # Fetch the user by card_id
     conn = get_db()
-    user = conn.execute("SELECT * FROM users WHERE card_id = ?", (card_id,)).fetchone()
-    if not user:
-        flash("❌ User not found for this card.", "danger")
-        return redirect(url_for('home'))
+    with unit_of_work(conn):
+        user = db.get_user_by_card(conn, card_id)
+        if not user:
+            flash("❌ User not found for this card.", "danger")
+            return redirect(url_for('home'))
 
-    # Update the user's balance
-    new_balance = user["balance"] + amount
-    conn.execute("UPDATE users SET balance = ? WHERE card_id = ?", (new_balance, card_id))
-    conn.commit()
+        # Update the user's balance and record the top-up
+        new_balance = db.update_balance(conn, card_id, amount, 'topup')
+    _publish_topup(card_id, amount, new_balance)
 
-    flash(f"✅ Payment successful! R{amount:.2f} added. New balance: R{new_balance:.2f}", "success")
+    flash(f"✅ Payment successful! {format_rands(amount)} added. New balance: {format_rands(new_balance)}", "success")
     return redirect(url_for('home'))
 
 # ------------------------------ MAIN ------------------------------ #
 if __name__ == '__main__':
-    init_db()
+    with startup.phase("schema check"):
+        init_db()
+    startup.warm_caches()
+    startup.report()
     app.run(host='0.0.0.0', port=5000, debug=True)
- 
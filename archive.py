@@ -0,0 +1,422 @@
+import os
+import sys
+import gzip
+import zlib
+import json
+import heapq
+from bisect import bisect_right
+from operator import itemgetter
+from itertools import groupby
+from datetime import datetime, timezone
+
+from db import DB_NAME, get_connection
+from money import to_cents
+
+# Archive lives next to the database file
+ARCHIVE_DIR = os.path.join(os.path.dirname(os.path.abspath(DB_NAME)), "archive")
+# 2: money columns in integer cents (version 1 files hold REAL rands)
+# 3: one gzip member per card, indexed by byte offset (1 and 2 index line numbers)
+# 4: card blocks listed in a sorted side file instead of a JSON dict of every card
+ARCHIVE_VERSION = 4
+CHUNK_ROWS = 5000  # live rows fetched at a time while archiving
+SPARSE_EVERY = 128  # lines of a sorted file between sparse index entries
+
+# table -> column that decides which month a row belongs to
+ARCHIVED_TABLES = {
+    "trip_history": "tap_out_time",
+    "transactions": "timestamp",
+}
+MONEY_COLUMNS = {"trip_history": "fare", "transactions": "amount"}
+# transactions.timestamp defaults to CURRENT_TIMESTAMP, which is UTC; trip times are local
+UTC_TABLES = {"transactions"}
+
+
+# --------------------------
+# File Layout
+# --------------------------
+# archive/<table>/<YYYY-MM>.ndjson.gz     one JSON row per line, sorted by card_id then time;
+#                                         each card's rows are a separate gzip member
+# archive/<table>/<YYYY-MM>.cards.ndjson  [card_id, [offset, length, count]] per card, sorted
+# archive/<table>/<YYYY-MM>.idx.json      {"version", "rows", "card_count", "sparse"}
+# archive/<table>/<YYYY-MM>.totals.ndjson [card_id, totals] per card, sorted; built on demand,
+#                                         with its sparse index in .totals.sparse.json
+# Versions 1-3 kept {card_id: block} for every card in idx.json instead.
+
+def _month_paths(table, month):
+    base = os.path.join(ARCHIVE_DIR, table, month)
+    return base + ".ndjson.gz", base + ".idx.json"
+
+
+def _cards_path(table, month):
+    return os.path.join(ARCHIVE_DIR, table, month) + ".cards.ndjson"
+
+
+def _totals_paths(table, month):
+    base = os.path.join(ARCHIVE_DIR, table, month)
+    return base + ".totals.ndjson", base + ".totals.sparse.json"
+
+
+# --------------------------
+# Sorted Line Files
+# --------------------------
+# [key, value] JSON lines in key order, plus a sparse [[key, byte offset]]
+# entry every SPARSE_EVERY lines. A lookup bisects the sparse list, seeks
+# and reads at most SPARSE_EVERY lines, whatever the file size.
+def _write_sorted(path, items):
+    """Write sorted (key, value) pairs and return the sparse index."""
+    sparse = []
+    with open(path, "wb") as f:
+        for n, (key, value) in enumerate(items):
+            if n % SPARSE_EVERY == 0:
+                sparse.append([key, f.tell()])
+            f.write(json.dumps([key, value], separators=(",", ":")).encode("utf-8") + b"\n")
+    return sparse
+
+
+def _iter_sorted(path, sparse, low=None):
+    """Yield (key, value) pairs from a sorted file, starting at the first key >= low."""
+    start = bisect_right(sparse, low, key=itemgetter(0)) - 1 if low is not None else -1
+    with open(path, "rb") as f:
+        f.seek(sparse[start][1] if start >= 0 else 0)
+        for line in f:
+            key, value = json.loads(line)
+            if low is None or key >= low:
+                yield key, value
+
+
+def archived_months(table):
+    """Return the archived months of a table, newest first."""
+    folder = os.path.join(ARCHIVE_DIR, table)
+    if not os.path.isdir(folder):
+        return []
+    months = [name[:-len(".idx.json")] for name in os.listdir(folder) if name.endswith(".idx.json")]
+    return sorted(months, reverse=True)
+
+
+_indexes = {}  # idx.json path -> ((st_ino, st_mtime_ns), index); version 4+ only, older ones list every card
+
+
+def _read_index(table, month):
+    _, idx_path = _month_paths(table, month)
+    st = os.stat(idx_path)
+    file_id = (st.st_ino, st.st_mtime_ns)
+    cached = _indexes.get(idx_path)
+    if cached and cached[0] == file_id:
+        return cached[1]
+    with open(idx_path) as f:
+        index = json.load(f)
+    if index["version"] >= 4:
+        _indexes[idx_path] = (file_id, index)
+    return index
+
+
+def _card_block(table, month, index, card_id):
+    if index["version"] < 4:
+        return index["cards"].get(card_id)
+    for key, block in _iter_sorted(_cards_path(table, month), index["sparse"], card_id):
+        return block if key == card_id else None
+    return None
+
+
+def _read_lines(table, month, index, card_id):
+    """Raw JSON lines of a month file, or of one card's block of it."""
+    data_path, _ = _month_paths(table, month)
+    if card_id is None:
+        # gzip reads concatenated members as one stream
+        with gzip.open(data_path, "rt", encoding="utf-8") as f:
+            yield from f
+        return
+
+    block = _card_block(table, month, index, card_id)
+    if not block:
+        return
+    if index["version"] >= 3:
+        # Seek straight to the card's own gzip member
+        offset, length, _ = block
+        with open(data_path, "rb") as f:
+            f.seek(offset)
+            data = zlib.decompress(f.read(length), wbits=31)
+        yield from data.decode("utf-8").splitlines()
+        return
+
+    # Versions 1-2 index line numbers: decompress up to the card's block
+    first, count = block
+    with gzip.open(data_path, "rt", encoding="utf-8") as f:
+        for lineno, line in enumerate(f):
+            if lineno >= first + count:
+                break
+            if lineno >= first:
+                yield line
+
+
+def _read_rows(table, month, card_id=None):
+    """Yield rows of one archived month, or just one card's rows."""
+    index = _read_index(table, month)
+    money = MONEY_COLUMNS[table] if index["version"] < 2 else None
+    for line in _read_lines(table, month, index, card_id):
+        row = json.loads(line)
+        if money and row[money] is not None:
+            row[money] = to_cents(row[money])
+        yield row
+
+
+def _row_key(table):
+    time_col = ARCHIVED_TABLES[table]
+    return lambda row: (row["card_id"], row[time_col] or "", row["id"])
+
+
+def _write_month(table, month, rows):
+    """Atomically (re)write a month file and its index from rows sorted by _row_key."""
+    data_path, idx_path = _month_paths(table, month)
+    cards_path = _cards_path(table, month)
+    os.makedirs(os.path.dirname(data_path), exist_ok=True)
+
+    counts = {"rows": 0, "card_count": 0}
+
+    def blocks(f):
+        # Writes each card's member and yields its block for the cards file
+        for card_id, block in groupby(rows, key=lambda row: row["card_id"]):
+            lines = [json.dumps(row, separators=(",", ":")) for row in block]
+            member = gzip.compress(("\n".join(lines) + "\n").encode("utf-8"))
+            yield card_id, [f.tell(), len(member), len(lines)]
+            f.write(member)
+            counts["rows"] += len(lines)
+            counts["card_count"] += 1
+
+    with open(data_path + ".tmp", "wb") as f:
+        sparse = _write_sorted(cards_path + ".tmp", blocks(f))
+    with open(idx_path + ".tmp", "w") as f:
+        json.dump({"version": ARCHIVE_VERSION, **counts, "sparse": sparse}, f)
+
+    # Data first: an index never points at a file that is not there yet
+    os.replace(data_path + ".tmp", data_path)
+    os.replace(cards_path + ".tmp", cards_path)
+    os.replace(idx_path + ".tmp", idx_path)
+    # Per-card totals are rebuilt from the new file when next asked for;
+    # the sparse index goes first since it marks the totals as built
+    for path in reversed(_totals_paths(table, month)):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+# --------------------------
+# Archival Job
+# --------------------------
+def _current_month(table):
+    now = datetime.now(timezone.utc) if table in UTC_TABLES else datetime.now()
+    return now.strftime("%Y-%m")
+
+
+def _next_month(month):
+    year, mon = map(int, month.split("-"))
+    return f"{year + mon // 12:04d}-{mon % 12 + 1:02d}"
+
+
+def _live_month(conn, table, month, counter):
+    """Stream one month of live rows in _row_key order, CHUNK_ROWS at a time.
+
+    The range on the time column uses its index; SQLite does the sort
+    (spilling to disk if it must), so memory stays flat however big the month.
+    `counter` collects [rows read, highest id read].
+    """
+    time_col = ARCHIVED_TABLES[table]
+    cur = conn.execute(f"""
+        SELECT * FROM {table} WHERE {time_col} >= ? AND {time_col} < ?
+        ORDER BY card_id, {time_col}, id
+    """, (month, _next_month(month)))
+    while True:
+        chunk = cur.fetchmany(CHUNK_ROWS)
+        if not chunk:
+            return
+        counter[0] += len(chunk)
+        counter[1] = max(counter[1], max(row["id"] for row in chunk))
+        yield from (dict(row) for row in chunk)
+
+
+def _merge_by_id(archived, live, key):
+    """Merge two sorted row streams; a live row replaces an archived row with the same id."""
+    previous = None
+    # On equal keys heapq.merge yields the archived row first, so the live one wins
+    for row in heapq.merge(archived, live, key=key):
+        if previous is not None and previous["id"] != row["id"]:
+            yield previous
+        previous = row
+    if previous is not None:
+        yield previous
+
+
+def archive_table(conn, table, before_month=None):
+    """Move every closed month of `table` older than `before_month` into the archive.
+
+    Returns {month: rows_moved}. Re-running is safe: rows already archived
+    for a month are merged by id, so a crash between writing the file and
+    deleting the live rows only leaves duplicates that the next run absorbs.
+    Only rows the month file holds are deleted: the read is one snapshot and
+    ids only grow, so a row written since has an id above the highest one read.
+    """
+    time_col = ARCHIVED_TABLES[table]
+    cutoff = before_month or _current_month(table)
+    if cutoff > _current_month(table):
+        raise ValueError("Cannot archive a month that has not closed yet")
+
+    moved = {}
+    # Jump from month to month with MIN() lookups on the time index
+    first = conn.execute(f"SELECT MIN({time_col}) FROM {table} WHERE {time_col} IS NOT NULL").fetchone()[0]
+    while first and first[:7] < cutoff:
+        month = first[:7]
+        counter = [0, 0]
+        archived = _read_rows(table, month) if month in archived_months(table) else iter(())
+        _write_month(table, month, _merge_by_id(archived, _live_month(conn, table, month, counter),
+                                                _row_key(table)))
+
+        conn.execute(f"DELETE FROM {table} WHERE {time_col} >= ? AND {time_col} < ? AND id <= ?",
+                     (month, _next_month(month), counter[1]))
+        conn.commit()
+        moved[month] = counter[0]
+        first = conn.execute(f"SELECT MIN({time_col}) FROM {table} WHERE {time_col} >= ?",
+                             (_next_month(month),)).fetchone()[0]
+
+    return moved
+
+
+def upgrade_months(table):
+    """Rewrite months archived in an older format; returns the months rewritten."""
+    upgraded = []
+    for month in archived_months(table):
+        if _read_index(table, month)["version"] < ARCHIVE_VERSION:
+            # Month files are already in _row_key order, so this streams
+            _write_month(table, month, _read_rows(table, month))
+            upgraded.append(month)
+    return upgraded
+
+
+def archive_closed_months(before_month=None, vacuum=False):
+    """Archive trip_history and transactions for all closed months."""
+    with get_connection() as conn:
+        result = {table: archive_table(conn, table, before_month) for table in ARCHIVED_TABLES}
+    for table in ARCHIVED_TABLES:
+        upgrade_months(table)
+
+    if vacuum:
+        with get_connection() as conn:
+            conn.execute("VACUUM")
+    return result
+
+
+# --------------------------
+# Read-through Queries
+# --------------------------
+def history_page(conn, table, card_id, before=None, before_id=None, limit=50):
+    """Return up to `limit` rows for a card, newest first, older than the cursor.
+
+    The cursor is the (time, id) of the last row of the previous page, so
+    rows sharing a timestamp are never skipped; `before` alone (no id)
+    means strictly older than that time. The live table is read first;
+    once it runs out, the archive is read month by month so callers never
+    need to know where the live window ends.
+    """
+    time_col = ARCHIVED_TABLES[table]
+    cursor = None if before is None else (before, -1 if before_id is None else before_id)
+
+    sql = f"SELECT * FROM {table} WHERE card_id = ?"
+    params = [card_id]
+    if cursor:
+        sql += f" AND ({time_col} < ? OR ({time_col} = ? AND id < ?))"
+        params += [cursor[0], cursor[0], cursor[1]]
+    sql += f" ORDER BY {time_col} DESC, id DESC LIMIT ?"
+    params.append(limit)
+
+    rows = [dict(row) for row in conn.execute(sql, params)]
+    if len(rows) >= limit:
+        return rows
+
+    seen = {row["id"] for row in rows}
+    if rows:
+        cursor = (rows[-1][time_col], rows[-1]["id"])
+    for month in archived_months(table):
+        if cursor and month > cursor[0][:7]:
+            continue
+        older = [row for row in _read_rows(table, month, card_id)
+                 if row["id"] not in seen and (not cursor or (row[time_col], row["id"]) < cursor)]
+        older.sort(key=lambda r: (r[time_col], r["id"]), reverse=True)
+        rows.extend(older[:limit - len(rows)])
+        if len(rows) >= limit:
+            break
+
+    return rows
+
+
+def archived_rows(table, card_id):
+    """Every archived row of one card, month by month."""
+    for month in archived_months(table):
+        yield from _read_rows(table, month, card_id)
+
+
+def iter_history(conn, table, card_id):
+    """Yield every row for a card, live and archived, newest first."""
+    time_col = ARCHIVED_TABLES[table]
+    before = before_id = None
+    while True:
+        page = history_page(conn, table, card_id, before=before, before_id=before_id, limit=500)
+        if not page:
+            return
+        yield from page
+        before, before_id = page[-1][time_col], page[-1]["id"]
+
+
+# --------------------------
+# Per-card Totals
+# --------------------------
+# Money per card per archived month, so the audit job can add archived
+# history without decompressing it. Transactions total by type; trips
+# total their fares.
+def _card_totals(table, rows):
+    money = MONEY_COLUMNS[table]
+    if table == "transactions":
+        totals = {}
+        for row in rows:
+            totals[row["type"]] = totals.get(row["type"], 0) + row[money]
+        return totals
+    return sum(row[money] or 0 for row in rows)
+
+
+def build_month_totals(table, month):
+    """Write the totals file for one archived month (if missing) and return its sparse index."""
+    path, sparse_path = _totals_paths(table, month)
+    try:
+        with open(sparse_path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        pass
+    cards = groupby(_read_rows(table, month), key=lambda row: row["card_id"])
+    sparse = _write_sorted(path + ".tmp", ((card, _card_totals(table, block)) for card, block in cards))
+    with open(sparse_path + ".tmp", "w") as f:
+        json.dump(sparse, f)
+    os.replace(path + ".tmp", path)
+    os.replace(sparse_path + ".tmp", sparse_path)
+    return sparse
+
+
+def iter_month_totals(table, month, low=None, high=None):
+    """Yield (card_id, totals) for cards in [low, high) from a month's totals file, in card order."""
+    sparse = build_month_totals(table, month)
+    path, _ = _totals_paths(table, month)
+    for card_id, totals in _iter_sorted(path, sparse, low):
+        if high is not None and card_id >= high:
+            return
+        yield card_id, totals
+
+
+# --------------------------
+# CLI
+# --------------------------
+if __name__ == "__main__":
+    # Usage: python archive.py [YYYY-MM] [--vacuum]
+    args = [arg for arg in sys.argv[1:] if arg != "--vacuum"]
+    result = archive_closed_months(args[0] if args else None, vacuum="--vacuum" in sys.argv)
+    for table, months in result.items():
+        for month, count in months.items():
+            print(f"[📦] {table} {month}: {count} rows archived")
+    print("✅ Archive complete.")
@@ -0,0 +1,274 @@
+import os
+import sys
+import json
+import heapq
+import sqlite3
+import argparse
+import tempfile
+from itertools import groupby
+from concurrent.futures import ProcessPoolExecutor
+
+import db
+import archive
+from db import DB_NAME, unit_of_work
+
+TRANSACTION_TYPES = ("topup", "fare", "refund", "adjustment")
+PARTITIONS_PER_WORKER = 4   # smaller partitions even out skew between workers
+FIX_BATCH = 500             # corrections written per transaction
+
+# Discrepancy kinds
+CARD_BALANCE = "card_balance"   # users.balance != virtual_cards.balance
+LEDGER = "ledger"               # users.balance != topups + refunds + adjustments - fares
+FARES = "fares"                 # fare transactions != fares in trip_history
+MISSING_USER = "missing_user"   # card rows, transactions or trips with no user
+
+
+# --------------------------
+# Sorted Sources
+# --------------------------
+# Each source yields (card_id, source, value) in card_id order for the
+# cards in [low, high). SQLite sorts with BINARY collation, which orders
+# UTF-8 like Python orders str, so the sources merge without re-sorting.
+def _range_sql(low, high):
+    sql, params = "", []
+    if low is not None:
+        sql += " AND card_id >= ?"
+        params.append(low)
+    if high is not None:
+        sql += " AND card_id < ?"
+        params.append(high)
+    return sql, params
+
+
+def _live_sources(conn, low, high):
+    where, params = _range_sql(low, high)
+    users = ((row[0], "user", row[1]) for row in conn.execute(
+        f"SELECT card_id, balance FROM users WHERE 1 {where} ORDER BY card_id", params))
+    cards = ((row[0], "card", row[1]) for row in conn.execute(
+        f"SELECT card_id, balance FROM virtual_cards WHERE 1 {where} ORDER BY card_id", params))
+    trips = ((row[0], "trips", row[1]) for row in conn.execute(
+        f"SELECT card_id, SUM(fare) FROM trip_history WHERE 1 {where} GROUP BY card_id ORDER BY card_id", params))
+    # Covered by idx_transactions_card: the index alone answers this
+    tx_rows = conn.execute(f"""
+        SELECT card_id, type, SUM(amount) FROM transactions WHERE 1 {where}
+        GROUP BY card_id, type ORDER BY card_id
+    """, params)
+    transactions = ((card_id, "transactions", {type_: total for _, type_, total in rows})
+                    for card_id, rows in groupby(tx_rows, key=lambda row: row[0]))
+    return [users, cards, trips, transactions]
+
+
+def _archived_month(table, source, month, low, high):
+    for card_id, totals in archive.iter_month_totals(table, month, low, high):
+        yield card_id, source, totals
+
+
+def _archive_sources(low, high):
+    return [_archived_month(table, source, month, low, high)
+            for table, source in (("transactions", "archived_transactions"), ("trip_history", "archived_trips"))
+            for month in archive.archived_months(table)]
+
+
+# --------------------------
+# Checks
+# --------------------------
+def _check_card(card_id, entries):
+    """Fold one card's merged entries into its evidence and return its discrepancies."""
+    evidence = {"user_balance": None, "card_balance": None,
+                **{type_: 0 for type_ in TRANSACTION_TYPES}, "trip_fares": 0,
+                "archived": {type_: 0 for type_ in TRANSACTION_TYPES} | {"trip_fares": 0}}
+    for _, source, value in entries:
+        if source == "user":
+            evidence["user_balance"] = value
+        elif source == "card":
+            evidence["card_balance"] = value
+        elif source == "trips":
+            evidence["trip_fares"] += value
+        elif source == "archived_trips":
+            evidence["trip_fares"] += value
+            evidence["archived"]["trip_fares"] += value
+        else:
+            for type_, total in value.items():
+                evidence[type_] += total
+                if source == "archived_transactions":
+                    evidence["archived"][type_] += total
+
+    ledger = evidence["topup"] + evidence["refund"] + evidence["adjustment"] - evidence["fare"]
+    balance = evidence["user_balance"]
+    found = []
+
+    def report(kind, expected, actual):
+        found.append({"card_id": card_id, "check": kind, "expected": expected, "actual": actual,
+                      "difference": None if expected is None or actual is None else actual - expected,
+                      "evidence": evidence})
+
+    if balance is None:
+        report(MISSING_USER, None, None)
+        return found
+    if evidence["card_balance"] != balance:
+        report(CARD_BALANCE, balance, evidence["card_balance"])
+    if ledger != balance:
+        report(LEDGER, ledger, balance)
+    if evidence["fare"] != evidence["trip_fares"]:
+        report(FARES, evidence["trip_fares"], evidence["fare"])
+    return found
+
+
+def audit_partition(db_name, low, high, out_path):
+    """Audit cards in [low, high) and write discrepancies to `out_path` as NDJSON."""
+    conn = sqlite3.connect(f"file:{db_name}?mode=ro", uri=True)
+    conn.execute("PRAGMA query_only = 1")
+    cards = found = 0
+    try:
+        # One read transaction: every live source comes from the same snapshot
+        conn.execute("BEGIN")
+        merged = heapq.merge(*_live_sources(conn, low, high), *_archive_sources(low, high),
+                             key=lambda entry: entry[0])
+        with open(out_path, "w") as out:
+            for card_id, entries in groupby(merged, key=lambda entry: entry[0]):
+                cards += 1
+                for discrepancy in _check_card(card_id, entries):
+                    out.write(json.dumps(discrepancy) + "\n")
+                    found += 1
+    finally:
+        conn.close()
+    return cards, found
+
+
+# --------------------------
+# Partitioning
+# --------------------------
+def partition_bounds(conn, partitions):
+    """Split the card space into `partitions` ranges of roughly equal user count."""
+    total = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+    step = -(-total // partitions) if total else 1
+    splits = [row[0] for row in conn.execute("""
+        SELECT card_id FROM (SELECT card_id, ROW_NUMBER() OVER (ORDER BY card_id) AS n FROM users)
+        WHERE n % ? = 1 AND n > 1
+    """, (step,))]
+    # Open ends catch transactions and trips for cards no user has
+    bounds = [None, *splits, None]
+    return list(zip(bounds, bounds[1:]))
+
+
+def run_audit(out=sys.stdout, workers=None, db_name=DB_NAME):
+    """Audit every card in parallel and stream discrepancies to `out` in card order.
+
+    Returns (cards_checked, discrepancies).
+    """
+    workers = workers or os.cpu_count() or 1
+    db.connect(db_name).close()  # schema check before workers open the file read-only
+    for table in archive.ARCHIVED_TABLES:
+        for month in archive.archived_months(table):
+            archive.build_month_totals(table, month)  # once here, not in every worker
+
+    conn = db.connect(db_name)
+    try:
+        ranges = partition_bounds(conn, workers * PARTITIONS_PER_WORKER)
+    finally:
+        conn.close()
+
+    cards = found = 0
+    with tempfile.TemporaryDirectory(prefix="audit-") as tmp:
+        paths = [os.path.join(tmp, f"{i:05d}.ndjson") for i in range(len(ranges))]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = pool.map(audit_partition, [db_name] * len(ranges),
+                               [low for low, _ in ranges], [high for _, high in ranges], paths)
+            # Partitions finish in order of submission, so output stays sorted by card
+            for path, (checked, partition_found) in zip(paths, results):
+                cards += checked
+                found += partition_found
+                with open(path) as f:
+                    for line in f:
+                        out.write(line)
+    out.flush()
+    return cards, found
+
+
+# --------------------------
+# Corrections
+# --------------------------
+# users.balance is what taps charge against, so it is the source of
+# truth: card rows are set to it, and a signed 'adjustment' transaction
+# brings the ledger up to it. Fare mismatches need a person: a missing
+# trip cannot be invented.
+def _current_ledger(conn, card_id):
+    """The card's ledger as of now, from live and archived transactions.
+
+    Re-read under the write lock rather than taken from the report: the
+    archiver may have moved rows out of the live table since the audit.
+    It writes a month file before deleting the live rows, so rows are
+    merged by id and one caught mid-move counts once.
+    """
+    rows = {row["id"]: (row["type"], row["amount"]) for row in archive.archived_rows("transactions", card_id)}
+    rows.update((row["id"], (row["type"], row["amount"])) for row in conn.execute(
+        "SELECT id, type, amount FROM transactions WHERE card_id = ?", (card_id,)))
+    return sum(-amount if type_ == "fare" else amount for type_, amount in rows.values())
+
+
+def _fix(conn, discrepancy):
+    card_id = discrepancy["card_id"]
+    user = db.get_user_by_card(conn, card_id)
+    if user is None:
+        return False
+
+    if discrepancy["check"] == CARD_BALANCE:
+        # Upsert: the card row itself may be the thing missing
+        cur = conn.execute("""
+        INSERT INTO virtual_cards (card_id, user_id, balance) VALUES (?, ?, ?)
+        ON CONFLICT(card_id) DO UPDATE SET balance = excluded.balance WHERE balance != excluded.balance
+        """, (card_id, user["id"], user["balance"]))
+        return cur.rowcount > 0
+
+    if discrepancy["check"] == LEDGER:
+        ledger = _current_ledger(conn, card_id)
+        if ledger == user["balance"]:
+            return False
+        db.record_transaction(conn, user["id"], card_id, user["balance"] - ledger, "adjustment")
+        return True
+    return False
+
+
+def apply_fixes(lines):
+    """Write corrections for the discrepancies in an NDJSON stream. Returns how many were applied."""
+    fixed = 0
+    batch = []
+    for line in lines:
+        batch.append(json.loads(line))
+        if len(batch) >= FIX_BATCH:
+            fixed += _fix_batch(batch)
+            batch = []
+    if batch:
+        fixed += _fix_batch(batch)
+    return fixed
+
+
+def _fix_batch(batch):
+    with unit_of_work() as conn:
+        return sum(_fix(conn, discrepancy) for discrepancy in batch)
+
+
+# --------------------------
+# CLI
+# --------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reconcile balances, transactions and trip fares per card")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: CPU count)")
+    parser.add_argument("--out", default="-", help="NDJSON discrepancy report (default: stdout)")
+    parser.add_argument("--fix", action="store_true", help="write correcting entries after the audit")
+    args = parser.parse_args()
+
+    out = sys.stdout if args.out == "-" else open(args.out, "w")
+    if args.fix and out is sys.stdout:
+        # The fix pass re-reads the report, so it needs a file
+        out = tempfile.NamedTemporaryFile("w+", prefix="audit-", suffix=".ndjson", delete=False)
+    cards, found = run_audit(out, args.workers)
+    print(f"[🔍] {cards} cards audited, {found} discrepancies.", file=sys.stderr)
+
+    if args.fix:
+        out.close()
+        with open(out.name) as f:
+            fixed = apply_fixes(f)
+        print(f"[🛠️] {fixed} corrections written (report: {out.name}).", file=sys.stderr)
+    elif out is not sys.stdout:
+        out.close()
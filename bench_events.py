@@ -0,0 +1,118 @@
+import os
+import sys
+import time
+import socket
+import argparse
+import subprocess
+import http.client
+from urllib.parse import urlencode
+
+from bench_serve import HERE, _wait_for_port
+
+# --------------------------
+# Live Stream Cost Benchmark
+# --------------------------
+# Starts serve.py with one worker, opens N /events streams against it and
+# reports what they cost: the worker's memory and threads, and the latency
+# of ordinary requests served alongside them. Linux only (reads /proc).
+# Registers a throwaway user in the database serve.py opens, so run it
+# from a scratch directory.
+# Usage: python bench_events.py [--streams N] [--requests R]
+PATH = "/"
+
+
+def _login(port):
+    """Register a throwaway user and return its session cookie."""
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    email = f"bench-{os.getpid()}-{time.time_ns()}@example.com"
+    body = urlencode({"name": "Bench", "surname": "User", "email": email, "dob": "2000-01-01", "password": "bench"})
+    conn.request("POST", "/register", body, {"Content-Type": "application/x-www-form-urlencoded"})
+    response = conn.getresponse()
+    response.read()
+    conn.close()
+    cookie = response.getheader("Set-Cookie")
+    if not cookie:
+        raise RuntimeError(f"POST /register returned {response.status} without a session")
+    return cookie.split(";", 1)[0]
+
+
+def _worker_pid(server):
+    # serve.py forks the replica refresher first, then the worker
+    with open(f"/proc/{server.pid}/task/{server.pid}/children") as f:
+        return int(f.read().split()[-1])
+
+
+def _status(pid):
+    """(resident MB, threads) of a process."""
+    fields = {}
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            fields[key] = value.split()
+    return int(fields["VmRSS"][0]) / 1024, int(fields["Threads"][0])
+
+
+def _latency(port, requests):
+    """(p50, p99) milliseconds for GET PATH, one connection per request."""
+    times = []
+    for _ in range(requests):
+        started = time.perf_counter()
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        conn.request("GET", PATH)
+        conn.getresponse().read()
+        conn.close()
+        times.append((time.perf_counter() - started) * 1000)
+    times.sort()
+    return times[len(times) // 2], times[int(len(times) * 0.99)]
+
+
+def _open_stream(port, cookie):
+    sock = socket.create_connection(("127.0.0.1", port))
+    sock.sendall(f"GET /events HTTP/1.1\r\nHost: bench\r\nCookie: {cookie}\r\n\r\n".encode())
+    return sock
+
+
+def run(streams, requests, port):
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, "serve.py"), "--host", "127.0.0.1",
+         "--port", str(port), "--workers", "1"],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,  # per-request access log
+    )
+    socks = []
+    try:
+        _wait_for_port(port)
+        cookie = _login(port)
+        _latency(port, 10)  # warm up
+        pid = _worker_pid(server)
+        rows = [("no streams", *_status(pid), *_latency(port, requests))]
+
+        for _ in range(streams):
+            socks.append(_open_stream(port, cookie))
+        for sock in socks:
+            sock.recv(4096)  # headers and the first balance event: the stream is live
+        rows.append((f"{streams} streams", *_status(pid), *_latency(port, requests)))
+
+        extra = _open_stream(port, cookie)
+        status_line = extra.recv(4096).split(b"\r\n", 1)[0].decode()
+        extra.close()
+    finally:
+        for sock in socks:
+            sock.close()
+        server.terminate()
+        server.wait()
+    return rows, status_line
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure what open /events streams cost one serve.py worker")
+    parser.add_argument("--streams", type=int, default=1000, help="streams to open (default: events.MAX_SUBSCRIBERS)")
+    parser.add_argument("--requests", type=int, default=200, help="timed requests per measurement")
+    parser.add_argument("--port", type=int, default=5077)
+    args = parser.parse_args()
+
+    rows, status_line = run(args.streams, args.requests, args.port)
+    print(f"{'':>14} {'RSS MB':>8} {'threads':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    for label, rss, threads, p50, p99 in rows:
+        print(f"{label:>14} {rss:>8.0f} {threads:>8} {p50:>8.2f} {p99:>8.2f}")
+    print(f"stream {args.streams + 1}: {status_line}")
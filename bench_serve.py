@@ -0,0 +1,75 @@
+import os
+import sys
+import time
+import socket
+import argparse
+import subprocess
+import http.client
+from multiprocessing import Pool
+
+# --------------------------
+# Prefork Scaling Benchmark
+# --------------------------
+# Starts serve.py with 1..N workers and measures requests/second on the
+# home page (template render, no DB writes) from several client processes.
+# Usage: python bench_serve.py [--max-workers N] [--clients C] [--requests R]
+HERE = os.path.dirname(os.path.abspath(__file__))
+PATH = "/"
+
+
+def _wait_for_port(port, timeout=15):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"server on port {port} did not start")
+
+
+def _client(args):
+    port, requests = args
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    for _ in range(requests):
+        conn.request("GET", PATH)
+        response = conn.getresponse()
+        response.read()
+        if response.status != 200:
+            raise RuntimeError(f"GET {PATH} returned {response.status}")
+    conn.close()
+
+
+def run(workers, clients, requests, port):
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, "serve.py"), "--host", "127.0.0.1",
+         "--port", str(port), "--workers", str(workers)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,  # per-request access log
+    )
+    try:
+        _wait_for_port(port)
+        with Pool(clients) as pool:
+            started = time.perf_counter()
+            pool.map(_client, [(port, requests)] * clients)
+            elapsed = time.perf_counter() - started
+    finally:
+        server.terminate()
+        server.wait()
+    return clients * requests / elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure serve.py throughput from 1 to N workers")
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=250, help="requests per client")
+    parser.add_argument("--port", type=int, default=5055)
+    args = parser.parse_args()
+
+    baseline = None
+    print(f"{'workers':>7} {'req/s':>10} {'speedup':>8}")
+    for workers in range(1, args.max_workers + 1):
+        rps = run(workers, args.clients, args.requests, args.port + workers)
+        baseline = baseline or rps
+        print(f"{workers:>7} {rps:>10.0f} {rps / baseline:>7.2f}x", flush=True)
@@ -1,6 +1,36 @@
+import os
+import time
+import secrets
+
 PAYSTACK_SECRET_KEY = 'sk_test_627b83359adc398ce6b27f5f8c2dc67097f44cb9'
 PAYSTACK_PUBLIC_KEY = 'pk_test_22982eb398839e7d73a69039eb1849b4c29228eb'
 PAYSTACK_CALLBACK_URL = 'https://tethnix1211.pythonanywhere.com/payment/callback'
 
 
+# Bearer token for the /admin API. Unset means the admin API is disabled.
+ADMIN_TOKEN = os.environ.get('TRANSIT_ADMIN_TOKEN')
+
+
+# Flask session key, shared by every worker process. Set TRANSIT_SECRET_KEY
+# in production; otherwise one is generated once and kept in SECRET_KEY_FILE.
+SECRET_KEY_FILE = 'secret_key'
 
+def load_secret_key():
+    key = os.environ.get('TRANSIT_SECRET_KEY')
+    if key:
+        return key
+    try:
+        # O_EXCL: when several workers start at once, exactly one creates the file
+        fd = os.open(SECRET_KEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        with open(SECRET_KEY_FILE) as f:
+            key = f.read().strip()
+        if key:
+            return key
+        # Another worker is still writing it
+        time.sleep(0.1)
+        return load_secret_key()
+    key = secrets.token_hex(32)
+    with os.fdopen(fd, 'w') as f:
+        f.write(key)
+    return key
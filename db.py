@@ -1,3 +1,4 @@
+import re
 import sqlite3
 from contextlib import contextmanager
 from datetime import datetime
@@ -9,233 +10,541 @@ DB_NAME = "transit_fare.db"
 # --------------------------
 # Connection Management
 # --------------------------
+BUSY_TIMEOUT = 30  # seconds to wait on a locked database
+_schema_checked = set()  # database files whose schema this process has verified
+
+
+class Connection(sqlite3.Connection):
+    """sqlite3 connection that can also undo changes made outside the database.
+
+    Code that changes state a rollback cannot reach (the active-trip
+    journal) registers an undo step with on_rollback. Rolling back, or
+    closing with the transaction still open, runs the steps newest first;
+    committing forgets them.
+
+    before_commit defers such a change to commit time instead: the hooks
+    run just before the database commits, so outside state never runs
+    ahead of a transaction that is still open. If the hooks or the
+    commit fail, the hooks' own undo steps put things back on rollback.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.undo_log = []
+        self.commit_hooks = []
+
+    def on_rollback(self, fn):
+        self.undo_log.append(fn)
+
+    def before_commit(self, fn):
+        self.commit_hooks.append(fn)
+
+    def undo(self, mark=0):
+        """Run the undo steps registered since len(undo_log) was `mark`, newest first."""
+        while len(self.undo_log) > mark:
+            self.undo_log.pop()()
+
+    def commit(self):
+        while self.commit_hooks:
+            self.commit_hooks.pop(0)()
+        super().commit()
+        self.undo_log.clear()
+
+    def rollback(self):
+        self.commit_hooks.clear()
+        try:
+            self.undo()
+        finally:
+            super().rollback()
+
+    def close(self):
+        self.commit_hooks.clear()
+        try:
+            self.undo()
+        finally:
+            super().close()
+
+
+def connect(db_name=None):
+    """Open a connection with WAL journaling and dict-like rows.
+
+    The first connection to each file in a process checks the schema version.
+    """
+    db_name = db_name or DB_NAME
+    conn = sqlite3.connect(db_name, timeout=BUSY_TIMEOUT, factory=Connection)
+    conn.row_factory = sqlite3.Row  # return dict-like rows
+    conn.execute("PRAGMA journal_mode=WAL")
+    if db_name not in _schema_checked:
+        ensure_schema(conn)
+        _schema_checked.add(db_name)
+    return conn
+
+
 @contextmanager
 def get_connection():
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row  # return dict-like rows
+    conn = connect()
     try:
         yield conn
-    finally:
         conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
         conn.close()
 
 
+@contextmanager
+def unit_of_work(conn=None):
+    """Run a whole business operation in one transaction.
+
+    Pass an existing connection (e.g. the per-request one) to reuse it,
+    otherwise a connection is opened and closed around the block. Nested
+    units of work join the outer transaction, so only the outermost one
+    commits. The write lock is taken up front (BEGIN IMMEDIATE) so a tap
+    never deadlocks upgrading a read lock under WAL.
+    """
+    owned = conn is None
+    if owned:
+        conn = connect()
+    try:
+        if conn.in_transaction:
+            yield conn
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            # Also when the commit itself fails, so undo steps still run
+            conn.rollback()
+            raise
+    finally:
+        if owned:
+            conn.close()
+
+
+@contextmanager
+def read_only(conn=None):
+    """Run read-only queries against one snapshot without taking the write lock.
+
+    A deferred BEGIN only takes a WAL read snapshot, so taps keep writing
+    while a long read (e.g. paging archived history) runs. Joins an open
+    transaction on a passed connection, like unit_of_work.
+    """
+    owned = conn is None
+    if owned:
+        conn = connect()
+    try:
+        if conn.in_transaction:
+            yield conn
+            return
+        conn.execute("BEGIN")
+        try:
+            yield conn
+        finally:
+            conn.rollback()
+    finally:
+        if owned:
+            conn.close()
+
+
 # --------------------------
 # Database Initialization
 # --------------------------
+# The schema version lives in PRAGMA user_version. Startup reads that one
+# integer and only runs DDL when the file is behind; MIGRATIONS[n] brings
+# a version n-1 database to version n.
+SCHEMA_VERSION = 7
+
+
+def ensure_schema(conn):
+    if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+        return
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # Re-read under the write lock: another process may have just migrated
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for target in range(version + 1, SCHEMA_VERSION + 1):
+            MIGRATIONS[target](conn)
+        conn.execute(f"PRAGMA user_version = {max(version, SCHEMA_VERSION)}")
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+
 def init_db():
-    with get_connection() as conn:
-        cur = conn.cursor()
-
-        # USERS TABLE
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            surname TEXT NOT NULL,
-            email TEXT NOT NULL UNIQUE,
-            dob TEXT NOT NULL,
-            password TEXT NOT NULL,
-            card_id TEXT NOT NULL UNIQUE,
-            balance REAL DEFAULT 0.0
-        )
-        """)
-
-        # VIRTUAL CARDS TABLE
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS virtual_cards (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            card_id TEXT NOT NULL UNIQUE,
-            user_id INTEGER NOT NULL,
-            balance REAL DEFAULT 0.0,
-            FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
-        )
-        """)
-
-        # TRIP HISTORY TABLE
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS trip_history (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            card_id TEXT NOT NULL,
-            tap_in_lat REAL,
-            tap_in_lng REAL,
-            tap_in_time TEXT,
-            tap_out_lat REAL,
-            tap_out_lng REAL,
-            tap_out_time TEXT,
-            fare REAL DEFAULT 0.0,
-            FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE,
-            FOREIGN KEY(card_id) REFERENCES virtual_cards(card_id) ON DELETE CASCADE
-        )
-        """)
-
-        # TRIP SESSIONS TABLE
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS trip_sessions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            card_id TEXT NOT NULL,
-            start_time TEXT NOT NULL,
-            start_lat REAL NOT NULL,
-            start_lon REAL NOT NULL
-        )
-        """)
-
-        # TRANSACTIONS TABLE (Top-ups + Deductions)
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS transactions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            card_id TEXT NOT NULL,
-            amount REAL NOT NULL,
-            type TEXT CHECK(type IN ('topup', 'fare', 'refund')) NOT NULL,
-            timestamp TEXT DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE,
-            FOREIGN KEY(card_id) REFERENCES virtual_cards(card_id) ON DELETE CASCADE
-        )
-        """)
+    """Create or upgrade the schema (cheap when it is already current)."""
+    connect().close()
+
+
+def _create_tables(conn):
+    """Version 1: the original tables (IF NOT EXISTS, so pre-versioning files upgrade cleanly)."""
+    cur = conn.cursor()
+
+    # USERS TABLE
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        surname TEXT NOT NULL,
+        email TEXT NOT NULL UNIQUE,
+        dob TEXT NOT NULL,
+        password TEXT NOT NULL,
+        card_id TEXT NOT NULL UNIQUE,
+        balance REAL DEFAULT 0.0
+    )
+    """)
+
+    # VIRTUAL CARDS TABLE
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS virtual_cards (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        card_id TEXT NOT NULL UNIQUE,
+        user_id INTEGER NOT NULL,
+        balance REAL DEFAULT 0.0,
+        FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
+    )
+    """)
+
+    # TRIP HISTORY TABLE
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS trip_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        card_id TEXT NOT NULL,
+        tap_in_lat REAL,
+        tap_in_lng REAL,
+        tap_in_time TEXT,
+        tap_out_lat REAL,
+        tap_out_lng REAL,
+        tap_out_time TEXT,
+        fare REAL DEFAULT 0.0,
+        FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE,
+        FOREIGN KEY(card_id) REFERENCES virtual_cards(card_id) ON DELETE CASCADE
+    )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_trip_history_card ON trip_history(card_id, tap_out_time)")
+
+    # TRIP SESSIONS TABLE
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS trip_sessions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        card_id TEXT NOT NULL,
+        start_time TEXT NOT NULL,
+        start_lat REAL NOT NULL,
+        start_lon REAL NOT NULL
+    )
+    """)
+
+    # TRANSACTIONS TABLE (Top-ups + Deductions)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS transactions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        card_id TEXT NOT NULL,
+        amount REAL NOT NULL,
+        type TEXT CHECK(type IN ('topup', 'fare', 'refund')) NOT NULL,
+        timestamp TEXT DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE,
+        FOREIGN KEY(card_id) REFERENCES virtual_cards(card_id) ON DELETE CASCADE
+    )
+    """)
+
+
+def _rebuild_table(conn, table, create_sql, columns, converted):
+    """Recreate `table` from `create_sql`, copying `columns` and converting `converted` to cents."""
+    select = ", ".join(
+        f"CAST(ROUND(COALESCE({col}, 0) * 100) AS INTEGER)" if col in converted else col
+        for col in columns
+    )
+    conn.execute(create_sql.replace(f"CREATE TABLE {table}", f"CREATE TABLE {table}_new", 1))
+    conn.execute(f"INSERT INTO {table}_new ({', '.join(columns)}) SELECT {select} FROM {table}")
+    conn.execute(f"DROP TABLE {table}")
+    conn.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+
+
+def _money_to_cents(conn):
+    """Version 2: store money as INTEGER cents instead of REAL rands."""
+    _rebuild_table(conn, "users", """
+    CREATE TABLE users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        surname TEXT NOT NULL,
+        email TEXT NOT NULL UNIQUE,
+        dob TEXT NOT NULL,
+        password TEXT NOT NULL,
+        card_id TEXT NOT NULL UNIQUE,
+        balance INTEGER NOT NULL DEFAULT 0
+    )
+    """, ["id", "name", "surname", "email", "dob", "password", "card_id", "balance"], {"balance"})
+
+    _rebuild_table(conn, "virtual_cards", """
+    CREATE TABLE virtual_cards (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        card_id TEXT NOT NULL UNIQUE,
+        user_id INTEGER NOT NULL,
+        balance INTEGER NOT NULL DEFAULT 0,
+        FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
+    )
+    """, ["id", "card_id", "user_id", "balance"], {"balance"})
+
+    _rebuild_table(conn, "trip_history", """
+    CREATE TABLE trip_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        card_id TEXT NOT NULL,
+        tap_in_lat REAL,
+        tap_in_lng REAL,
+        tap_in_time TEXT,
+        tap_out_lat REAL,
+        tap_out_lng REAL,
+        tap_out_time TEXT,
+        fare INTEGER NOT NULL DEFAULT 0,
+        FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE,
+        FOREIGN KEY(card_id) REFERENCES virtual_cards(card_id) ON DELETE CASCADE
+    )
+    """, ["id", "user_id", "card_id", "tap_in_lat", "tap_in_lng", "tap_in_time",
+          "tap_out_lat", "tap_out_lng", "tap_out_time", "fare"], {"fare"})
+    conn.execute("CREATE INDEX idx_trip_history_card ON trip_history(card_id, tap_out_time)")
+
+    _rebuild_table(conn, "transactions", """
+    CREATE TABLE transactions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        card_id TEXT NOT NULL,
+        amount INTEGER NOT NULL,
+        type TEXT CHECK(type IN ('topup', 'fare', 'refund')) NOT NULL,
+        timestamp TEXT DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE,
+        FOREIGN KEY(card_id) REFERENCES virtual_cards(card_id) ON DELETE CASCADE
+    )
+    """, ["id", "user_id", "card_id", "amount", "type", "timestamp"], {"amount"})
+    # Exact per-card SUM(amount) rollups straight from the index
+    conn.execute("CREATE INDEX idx_transactions_card ON transactions(card_id, type, amount)")
+
+
+def _create_stations(conn):
+    """Version 3: stations, used to snap coordinates for fare quotes."""
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS stations (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        code TEXT NOT NULL UNIQUE,
+        name TEXT NOT NULL,
+        lat REAL NOT NULL,
+        lon REAL NOT NULL
+    )
+    """)
+
+
+def _add_adjustments(conn):
+    """Version 4: allow 'adjustment' transactions (signed corrections written by audit.py)."""
+    _rebuild_table(conn, "transactions", """
+    CREATE TABLE transactions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        card_id TEXT NOT NULL,
+        amount INTEGER NOT NULL,
+        type TEXT CHECK(type IN ('topup', 'fare', 'refund', 'adjustment')) NOT NULL,
+        timestamp TEXT DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE,
+        FOREIGN KEY(card_id) REFERENCES virtual_cards(card_id) ON DELETE CASCADE
+    )
+    """, ["id", "user_id", "card_id", "amount", "type", "timestamp"], set())
+    conn.execute("CREATE INDEX idx_transactions_card ON transactions(card_id, type, amount)")
+
+
+def _create_user_search(conn):
+    """Version 5: FTS5 index over users for admin search, kept in sync by triggers."""
+    conn.execute("""
+    CREATE VIRTUAL TABLE users_fts USING fts5(
+        name, surname, email, card_id,
+        content='users', content_rowid='id',
+        -- emails and card IDs stay whole tokens, so "ann.lee@" or "05902205-1b" prefix-match
+        tokenize="unicode61 tokenchars '@.-_+'",
+        prefix='2 3'
+    )
+    """)
+    conn.execute("INSERT INTO users_fts(users_fts) VALUES ('rebuild')")
+    conn.execute("""
+    CREATE TRIGGER users_fts_insert AFTER INSERT ON users BEGIN
+        INSERT INTO users_fts(rowid, name, surname, email, card_id)
+        VALUES (new.id, new.name, new.surname, new.email, new.card_id);
+    END
+    """)
+    conn.execute("""
+    CREATE TRIGGER users_fts_delete AFTER DELETE ON users BEGIN
+        INSERT INTO users_fts(users_fts, rowid, name, surname, email, card_id)
+        VALUES ('delete', old.id, old.name, old.surname, old.email, old.card_id);
+    END
+    """)
+    # Only the indexed columns: balance updates on every tap must not touch the index
+    conn.execute("""
+    CREATE TRIGGER users_fts_update AFTER UPDATE OF name, surname, email, card_id ON users BEGIN
+        INSERT INTO users_fts(users_fts, rowid, name, surname, email, card_id)
+        VALUES ('delete', old.id, old.name, old.surname, old.email, old.card_id);
+        INSERT INTO users_fts(rowid, name, surname, email, card_id)
+        VALUES (new.id, new.name, new.surname, new.email, new.card_id);
+    END
+    """)
+
+
+def _index_history_times(conn):
+    """Version 6: time indexes so archival can range-scan one month at a time."""
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_transactions_timestamp ON transactions(timestamp)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_trip_history_tap_out ON trip_history(tap_out_time)")
+
+
+def _backfill_virtual_cards(conn):
+    """Version 7: card rows for users registered through the web before it created them."""
+    conn.execute("""
+    INSERT INTO virtual_cards (card_id, user_id, balance)
+    SELECT card_id, id, balance FROM users
+    WHERE card_id NOT IN (SELECT card_id FROM virtual_cards)
+    """)
+
+
+MIGRATIONS = {
+    1: _create_tables,
+    2: _money_to_cents,
+    3: _create_stations,
+    4: _add_adjustments,
+    5: _create_user_search,
+    6: _index_history_times,
+    7: _backfill_virtual_cards,
+}
 
 
 # --------------------------
 # User & Card Management
 # --------------------------
-def create_user(name, surname, email, dob, password, card_id):
-    with get_connection() as conn:
-        cur = conn.cursor()
-        cur.execute("""
-        INSERT INTO users (name, surname, email, dob, password, card_id)
-        VALUES (?, ?, ?, ?, ?, ?)
-        """, (name, surname, email, dob, password, card_id))
-        return cur.lastrowid
+# Every function below takes the connection of the current unit of work.
+def create_user(conn, name, surname, email, dob, password, card_id):
+    cur = conn.execute("""
+    INSERT INTO users (name, surname, email, dob, password, card_id)
+    VALUES (?, ?, ?, ?, ?, ?)
+    """, (name, surname, email, dob, password, card_id))
+    return cur.lastrowid
+
+
+def create_virtual_card(conn, user_id, card_id):
+    cur = conn.execute("""
+    INSERT INTO virtual_cards (card_id, user_id) VALUES (?, ?)
+    """, (card_id, user_id))
+    return cur.lastrowid
 
 
-def create_virtual_card(user_id, card_id):
-    with get_connection() as conn:
-        cur = conn.cursor()
-        cur.execute("""
-        INSERT INTO virtual_cards (card_id, user_id) VALUES (?, ?)
-        """, (card_id, user_id))
-        return cur.lastrowid
+def get_user_by_email(conn, email):
+    return conn.execute("SELECT * FROM users WHERE email = ?", (email,)).fetchone()
 
 
-def get_user_by_email(email):
-    with get_connection() as conn:
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM users WHERE email = ?", (email,))
-        return cur.fetchone()
+def get_user_by_id(conn, user_id):
+    return conn.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
 
 
-def get_cards_by_user(user_id):
-    with get_connection() as conn:
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM virtual_cards WHERE user_id = ?", (user_id,))
-        return cur.fetchall()
+def get_user_by_card(conn, card_id):
+    return conn.execute("SELECT * FROM users WHERE card_id = ?", (card_id,)).fetchone()
+
+
+def get_cards_by_user(conn, user_id):
+    return conn.execute("SELECT * FROM virtual_cards WHERE user_id = ?", (user_id,)).fetchall()
 
 
 # --------------------------
-# Balance & Transactions
+# Admin Search
 # --------------------------
-def record_transaction(user_id, card_id, amount, type_):
-    with get_connection() as conn:
-        cur = conn.cursor()
-        cur.execute("""
-        INSERT INTO transactions (user_id, card_id, amount, type)
-        VALUES (?, ?, ?, ?)
-        """, (user_id, card_id, amount, type_))
-
-
-def update_balance(card_id, amount, type_):
-    """Updates balance and records a transaction"""
-    with get_connection() as conn:
-        cur = conn.cursor()
-
-        # Get user_id from card
-        cur.execute("SELECT user_id FROM virtual_cards WHERE card_id = ?", (card_id,))
-        card = cur.fetchone()
-        if not card:
-            raise ValueError("Card not found")
-
-        user_id = card["user_id"]
-
-        # Update balance
-        if type_ == "topup":
-            cur.execute("UPDATE virtual_cards SET balance = balance + ? WHERE card_id = ?", (amount, card_id))
-            cur.execute("UPDATE users SET balance = balance + ? WHERE id = ?", (amount, user_id))
-        elif type_ == "fare":
-            cur.execute("UPDATE virtual_cards SET balance = balance - ? WHERE card_id = ?", (amount, card_id))
-            cur.execute("UPDATE users SET balance = balance - ? WHERE id = ?", (amount, user_id))
-
-        # Record transaction
-        record_transaction(user_id, card_id, amount, type_)
-
-
-def get_transactions(card_id):
-    with get_connection() as conn:
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM transactions WHERE card_id = ? ORDER BY timestamp DESC", (card_id,))
-        return cur.fetchall()
-
-
-def get_total_topped_up(user_id):
-    with get_connection() as conn:
-        cur = conn.cursor()
-        cur.execute("""
-        SELECT SUM(amount) as total
-        FROM transactions
-        WHERE user_id = ? AND type = 'topup'
-        """, (user_id,))
-        row = cur.fetchone()
-        return row["total"] if row and row["total"] else 0.0
+def _match_query(text):
+    """Turn free text into an FTS5 query: every word must match as a prefix."""
+    words = re.findall(r"[\w@.+-]+", text.lower())
+    return " ".join(f'"{word}"*' for word in words)
+
+
+def search_users(conn, text, before=None, limit=20):
+    """Users whose name, surname, email or card ID match every word of `text` as a prefix.
+
+    Newest accounts first; pass the last row's id as `before` for the next
+    page. Rowid order lets FTS5 stop after `limit` matches instead of
+    ranking every one, which keeps short prefixes fast on large tables.
+    """
+    query = _match_query(text)
+    if not query:
+        return []
+    sql = """
+    SELECT users.id, users.card_id, users.name, users.surname, users.email, users.balance
+    FROM users_fts JOIN users ON users.id = users_fts.rowid
+    WHERE users_fts MATCH ?
+    """
+    params = [query]
+    if before is not None:
+        sql += " AND users_fts.rowid < ?"
+        params.append(before)
+    sql += " ORDER BY users_fts.rowid DESC LIMIT ?"
+    params.append(limit)
+    return conn.execute(sql, params).fetchall()
 
 
 # --------------------------
-# Trips
+# Balance & Transactions
 # --------------------------
-def start_trip(card_id, lat, lon):
-    with get_connection() as conn:
-        cur = conn.cursor()
-        cur.execute("""
-        INSERT INTO trip_sessions (card_id, start_time, start_lat, start_lon)
-        VALUES (?, ?, ?, ?)
-        """, (card_id, datetime.now().isoformat(), lat, lon))
-        return cur.lastrowid
-
-
-def end_trip(card_id, lat, lon, fare, user_id):
-    with get_connection() as conn:
-        cur = conn.cursor()
-
-        # Find active session
-        cur.execute("SELECT * FROM trip_sessions WHERE card_id = ? ORDER BY id DESC LIMIT 1", (card_id,))
-        session = cur.fetchone()
-        if not session:
-            raise ValueError("No active trip session for this card")
-
-        # Insert into trip_history
-        cur.execute("""
-        INSERT INTO trip_history (user_id, card_id, tap_in_lat, tap_in_lng, tap_in_time,
-                                  tap_out_lat, tap_out_lng, tap_out_time, fare)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            user_id,
-            card_id,
-            session["start_lat"],
-            session["start_lon"],
-            session["start_time"],
-            lat,
-            lon,
-            datetime.now().isoformat(),
-            fare
-        ))
-
-        # Deduct fare
-        update_balance(card_id, fare, "fare")
-
-        # Delete session
-        cur.execute("DELETE FROM trip_sessions WHERE id = ?", (session["id"],))
+def record_transaction(conn, user_id, card_id, amount, type_):
+    conn.execute("""
+    INSERT INTO transactions (user_id, card_id, amount, type)
+    VALUES (?, ?, ?, ?)
+    """, (user_id, card_id, amount, type_))
+
+
+def update_balance(conn, card_id, amount, type_):
+    """Updates balance, records a transaction and returns the new balance (all in cents)"""
+    user = get_user_by_card(conn, card_id)
+    if not user:
+        raise ValueError("Card not found")
+
+    delta = -amount if type_ == "fare" else amount
+    conn.execute("UPDATE virtual_cards SET balance = balance + ? WHERE card_id = ?", (delta, card_id))
+    conn.execute("UPDATE users SET balance = balance + ? WHERE id = ?", (delta, user["id"]))
+
+    record_transaction(conn, user["id"], card_id, amount, type_)
+    return user["balance"] + delta
+
+
+def get_transactions(conn, card_id):
+    return conn.execute(
+        "SELECT * FROM transactions WHERE card_id = ? ORDER BY timestamp DESC", (card_id,)
+    ).fetchall()
+
+
+def get_total_topped_up(conn, user_id):
+    row = conn.execute("""
+    SELECT SUM(amount) as total
+    FROM transactions
+    WHERE user_id = ? AND type = 'topup'
+    """, (user_id,)).fetchone()
+    return row["total"] if row and row["total"] else 0
 
 
 # --------------------------
-# Initialize DB on Import
+# Trips
 # --------------------------
-init_db()
+# Open trips live in trip_store.active_trips; trip_sessions is only read
+# once, to import sessions left open by older versions.
+def end_trip(conn, trip, lat, lon, fare, user_id):
+    """Write a completed trip to trip_history, charge the fare and return the new balance."""
+    conn.execute("""
+    INSERT INTO trip_history (user_id, card_id, tap_in_lat, tap_in_lng, tap_in_time,
+                              tap_out_lat, tap_out_lng, tap_out_time, fare)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, (
+        user_id,
+        trip["card_id"],
+        trip["start_lat"],
+        trip["start_lon"],
+        trip["start_time"],
+        lat,
+        lon,
+        datetime.now().isoformat(),
+        fare
+    ))
+
+    # Deduct fare
+    return update_balance(conn, trip["card_id"], fare, "fare")
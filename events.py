@@ -0,0 +1,196 @@
+import os
+import json
+import time
+import threading
+from collections import deque
+
+import startup
+
+QUEUE_LENGTH = 32           # undelivered events kept per subscriber; older ones are dropped
+KEEPALIVE_SECONDS = 15      # comment line sent to idle streams so proxies keep them open
+# Open streams per process. The bus keeps a stream for a deque and an
+# Event, but each stream also holds one server thread blocked in
+# Subscriber.get for as long as the page is open. bench_events.py
+# measured a full worker at 1000 streams: RSS 30 -> 208 MB, and
+# p50/p99 of other requests unchanged (1.4/3.7 ms -> 1.6/2.6 ms).
+# The blocked threads cost memory, not latency, so the cap bounds
+# memory. Scale streams with worker processes, not with this number.
+MAX_SUBSCRIBERS = 1000
+RELAY_POLL_SECONDS = 0.5    # how often a worker looks for events published by other processes
+RELAY_TTL_SECONDS = 60      # how long a shared event stays readable
+LISTENING_TTL_SECONDS = 10  # how long a process's "I have streams open" marker lasts
+
+# Event types
+BALANCE = "balance"
+TAP = "tap"
+TOPUP = "topup"
+
+
+# --------------------------
+# Subscribers
+# --------------------------
+class Subscriber:
+    """One open stream: a short queue of events for a single card."""
+
+    __slots__ = ("card_id", "_events", "_ready")
+
+    def __init__(self, card_id):
+        self.card_id = card_id
+        self._events = deque(maxlen=QUEUE_LENGTH)
+        self._ready = threading.Event()
+
+    def put(self, event):
+        self._events.append(event)
+        self._ready.set()
+
+    def get(self, timeout=KEEPALIVE_SECONDS):
+        """Return the pending events, waiting up to `timeout` seconds for one."""
+        if not self._events:
+            self._ready.wait(timeout)
+        self._ready.clear()
+        events = []
+        while self._events:
+            events.append(self._events.popleft())
+        return events
+
+
+def format_sse(event):
+    """Encode an event for a text/event-stream response."""
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(event['data'])}\n\n"
+
+
+# --------------------------
+# Event Bus
+# --------------------------
+class EventBus:
+    """In-process pub/sub keyed by card ID.
+
+    Publishing is a dict lookup and a deque append per open stream, so it
+    is cheap to call from request handlers after their transaction commits;
+    a card with nobody listening costs nothing.
+    """
+
+    def __init__(self):
+        self._subscribers = {}
+        self._lock = threading.Lock()
+        self._seq = 0
+        self.count = 0
+
+    def subscribe(self, card_id):
+        """Open a stream for a card. Returns None when the process is at MAX_SUBSCRIBERS."""
+        with self._lock:
+            if self.count >= MAX_SUBSCRIBERS:
+                return None
+            subscriber = Subscriber(card_id)
+            self._subscribers.setdefault(card_id, set()).add(subscriber)
+            self.count += 1
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(subscriber.card_id)
+            if subscribers and subscriber in subscribers:
+                subscribers.discard(subscriber)
+                self.count -= 1
+                if not subscribers:
+                    del self._subscribers[subscriber.card_id]
+
+    def _deliver(self, event):
+        with self._lock:
+            subscribers = list(self._subscribers.get(event["card_id"], ()))
+        for subscriber in subscribers:
+            subscriber.put(event)
+
+    def _next_id(self):
+        with self._lock:
+            self._seq += 1
+            return self._seq
+
+    def publish(self, card_id, type_, **data):
+        """Send an event to every open stream for `card_id`."""
+        event = {"id": self._next_id(), "card_id": card_id, "type": type_,
+                 "data": {"time": time.time(), **data}}
+        self._deliver(event)
+        return event
+
+
+class SharedEventBus(EventBus):
+    """EventBus for multi-process deployments.
+
+    Events are also written to a SharedState store under a global sequence
+    number; each process starts a relay thread with its first stream that
+    picks up events published by the others. Processes with open streams
+    keep an "events:listening" marker fresh; while no process has one,
+    publishing skips the store entirely.
+    """
+
+    def __init__(self, store):
+        super().__init__()
+        self.store = store
+        self._relay = None
+        self._listening_at = 0.0
+        startup.reset_after_fork(self, reset=self._after_fork)
+
+    def _after_fork(self):
+        # The parent's streams and relay thread stay with the parent
+        self._subscribers = {}
+        self.count = 0
+        self._relay = None
+        self._listening_at = 0.0
+
+    def _mark_listening(self):
+        self._listening_at = time.time()
+        self.store.set("events:listening", True, ttl=LISTENING_TTL_SECONDS)
+
+    def subscribe(self, card_id):
+        subscriber = super().subscribe(card_id)
+        if subscriber is not None:
+            self._mark_listening()
+            with self._lock:
+                if self._relay is None or not self._relay.is_alive():
+                    seen = self.store.get("events:seq", 0)
+                    self._relay = threading.Thread(target=self._run_relay, args=(seen,),
+                                                   name="event-relay", daemon=True)
+                    self._relay.start()
+        return subscriber
+
+    def publish(self, card_id, type_, **data):
+        if not self.store.get("events:listening"):
+            return super().publish(card_id, type_, **data)  # no streams anywhere: one read, no writes
+        event = {"card_id": card_id, "type": type_, "data": {"time": time.time(), **data}, "pid": os.getpid()}
+        # One transaction, so a relay never reads a sequence number whose event is not there yet
+        with self.store.transaction():
+            event["id"] = self.store.incr("events:seq")
+            self.store.set(f"events:{event['id']}", event, ttl=RELAY_TTL_SECONDS)
+        self._deliver(event)
+        return event
+
+    def _run_relay(self, seen):
+        while True:
+            time.sleep(RELAY_POLL_SECONDS)
+            latest = self.store.get("events:seq", 0)
+            if not self.count:
+                seen = latest  # nobody listening: skip, don't read
+                continue
+            if time.time() - self._listening_at > LISTENING_TTL_SECONDS / 2:
+                self._mark_listening()
+            for seq in range(seen + 1, latest + 1):
+                event = self.store.get(f"events:{seq}")
+                # Our own events were delivered when they were published
+                if event and event["pid"] != os.getpid():
+                    self._deliver(event)
+            seen = latest
+
+
+bus = EventBus()
+
+
+def use_shared_state(store):
+    """Switch the process-wide bus to shared state (call before forking workers)."""
+    global bus
+    bus = SharedEventBus(store)
+
+
+def publish(card_id, type_, **data):
+    """Publish on the process-wide bus."""
+    return bus.publish(card_id, type_, **data)
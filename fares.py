@@ -0,0 +1,306 @@
+import math
+import hashlib
+import threading
+from functools import lru_cache
+from array import array
+from datetime import datetime, timedelta
+
+import db
+import startup
+from stations import stations
+
+# Transfer rules: a tap-in close to where the card last tapped out, soon
+# after it did, continues the same journey -- unless the trip heads back
+# to where the journey began, or the journey is out of transfers or time.
+TRANSFER_WINDOW_MINUTES = 45
+TRANSFER_RADIUS_KM = 0.5
+TRANSFER_DISCOUNT = 1.0  # fraction of the fare waived on a transfer (1.0 = free)
+MAX_TRANSFERS = 2  # discounted connections per journey
+MAX_JOURNEY_MINUTES = 120  # from the journey's first tap-in to a connecting tap-in
+
+# (max distance in km, fare in cents); None is the open-ended top band
+FARE_BANDS = ((5, 1200), (10, 1800), (None, 2500))
+
+QUOTE_CACHE_SIZE = 100_000  # memoized origin/destination pairs
+
+
+# --------------------------
+# Distance & Fare Bands
+# --------------------------
+def calculate_distance_km(lat1, lon1, lat2, lon2):
+    """Calculate distance in kilometers using the Haversine formula."""
+    R = 6371  # Earth radius in km
+    lat1, lon1, lat2, lon2 = map(math.radians, [float(lat1), float(lon1), float(lat2), float(lon2)])
+    dlat = lat2 - lat1
+    dlon = lon2 - lon1
+    a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2)**2
+    c = 2 * math.asin(math.sqrt(a))
+    return R * c
+
+
+def parse_point(lat, lon):
+    """Return a tap location as finite (lat, lon) floats; raise ValueError if it is not one."""
+    try:
+        lat, lon = float(lat), float(lon)
+    except (TypeError, ValueError):
+        raise ValueError("coordinates must be numbers") from None
+    if not (math.isfinite(lat) and math.isfinite(lon)) or abs(lat) > 90 or abs(lon) > 180:
+        raise ValueError("coordinates out of range")
+    return lat, lon
+
+
+def get_fare(distance_km):
+    """Return fare price in cents based on distance."""
+    for max_km, fare in FARE_BANDS:
+        if max_km is None or distance_km <= max_km:
+            return fare
+
+
+def _timestamp(value):
+    """Epoch seconds from an ISO string (trip tables) or a number.
+
+    Rows written by the old CLI hold time.time() as text, e.g. '1700000000.5'.
+    """
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            return datetime.fromisoformat(value).timestamp()
+    return float(value)
+
+
+# --------------------------
+# Last-Trip Index
+# --------------------------
+# tap-out time, lat, lon, journey origin lat, lon, journey start time, transfers used
+LAST_TRIP_FIELDS = 7
+
+
+class LastTripIndex:
+    """Last tap-out and current journey of every card, in one flat array.
+
+    Each card holds LAST_TRIP_FIELDS doubles: tap-out time, lat and lon,
+    then the journey's origin lat and lon, its start time and the
+    transfers used so far. Cards map to a slot once; later tap-outs
+    overwrite that slot in place, so lookups and updates are O(1).
+    """
+    __slots__ = ("_slots", "_values", "_lock", "loaded")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clear()
+        startup.reset_after_fork(self)
+
+    def _clear(self):
+        self._slots = {}
+        self._values = array("d")
+        self.loaded = False
+
+    def __len__(self):
+        return len(self._slots)
+
+    def record(self, card_id, last):
+        """Store a card's last-trip tuple unless it already holds a later one."""
+        slot = self._slots.get(card_id)
+        if slot is None:
+            with self._lock:
+                slot = self._slots.get(card_id)
+                if slot is None:
+                    slot = len(self._values) // LAST_TRIP_FIELDS
+                    self._values.extend([0.0] * LAST_TRIP_FIELDS)
+                    self._slots[card_id] = slot
+        base = slot * LAST_TRIP_FIELDS
+        if last[0] >= self._values[base]:
+            self._values[base:base + LAST_TRIP_FIELDS] = array("d", last)
+
+    def last(self, card_id):
+        """Return the card's last-trip tuple, or None."""
+        slot = self._slots.get(card_id)
+        if slot is None:
+            return None
+        base = slot * LAST_TRIP_FIELDS
+        return tuple(self._values[base:base + LAST_TRIP_FIELDS])
+
+    def rebuild(self, conn):
+        """Reload by replaying recent trip_history in tap-out order.
+
+        A card whose last tap-out is older than the transfer window cannot
+        transfer, so only rows recent enough to still shape a journey are read.
+        """
+        self._clear()
+        since = datetime.now() - timedelta(minutes=MAX_JOURNEY_MINUTES + TRANSFER_WINDOW_MINUTES)
+        rows = conn.execute("""
+            SELECT card_id, tap_in_time, tap_in_lat, tap_in_lng, tap_out_time, tap_out_lat, tap_out_lng
+            FROM trip_history
+            WHERE tap_out_time >= ?
+            ORDER BY tap_out_time, id
+        """, (since.isoformat(),))
+        for row in rows:
+            try:
+                start_lat, start_lon = parse_point(row["tap_in_lat"] or 0.0, row["tap_in_lng"] or 0.0)
+                lat, lon = parse_point(row["tap_out_lat"] or 0.0, row["tap_out_lng"] or 0.0)
+                when = _timestamp(row["tap_out_time"])
+                trip = {"start_time": _timestamp(row["tap_in_time"]), "start_lat": start_lat, "start_lon": start_lon}
+            except (TypeError, ValueError):
+                continue  # a bad row must not stop every tap-out from pricing
+            _record_trip(self, row["card_id"], trip, lat, lon, when)
+        self.loaded = True
+
+
+class SharedLastTripIndex:
+    """LastTripIndex stored in a SharedState store, so every worker process sees every tap-out."""
+    __slots__ = ("store", "loaded")
+
+    # Past the window a card's last trip cannot start a transfer, so let it expire
+    TTL = TRANSFER_WINDOW_MINUTES * 60
+
+    def __init__(self, store):
+        self.store = store
+        self.loaded = False
+
+    def record(self, card_id, last):
+        self.store.set(f"last_trip:{card_id}", list(last), ttl=self.TTL)
+
+    def last(self, card_id):
+        last = self.store.get(f"last_trip:{card_id}")
+        # Entries written before journeys were tracked have fewer fields
+        return tuple(last) if last and len(last) == LAST_TRIP_FIELDS else None
+
+    def rebuild(self, conn):
+        local = LastTripIndex()
+        local.rebuild(conn)
+        self.store.set_many(((f"last_trip:{card_id}", list(local.last(card_id))) for card_id in local._slots),
+                            ttl=self.TTL)
+        self.loaded = True
+
+
+last_trips = LastTripIndex()
+
+
+def use_shared_state(store):
+    """Switch the process-wide index to shared state (call before forking workers)."""
+    global last_trips
+    last_trips = SharedLastTripIndex(store)
+
+
+def get_last_trips():
+    """The process-wide index, built from the database on first use."""
+    if not last_trips.loaded:
+        with db.get_connection() as conn:
+            last_trips.rebuild(conn)
+    return last_trips
+
+
+def _record_trip(index, card_id, trip, lat, lon, when):
+    last = index.last(card_id)
+    start_lat, start_lon = float(trip["start_lat"] or 0.0), float(trip["start_lon"] or 0.0)
+    start = _timestamp(trip["start_time"])
+    if _continues_journey(last, start, start_lat, start_lon, lat, lon):
+        _, _, _, origin_lat, origin_lon, journey_start, transfers = last
+        journey = (origin_lat, origin_lon, journey_start, transfers + 1)
+    else:
+        journey = (start_lat, start_lon, start, 0)
+    index.record(card_id, (when, float(lat or 0.0), float(lon or 0.0), *journey))
+
+
+def record_tap_out(card_id, trip, lat, lon, when=None):
+    """Call once the tap-out ending `trip` at (lat, lon) has committed."""
+    _record_trip(get_last_trips(), card_id, trip, lat, lon, when or datetime.now().timestamp())
+
+
+# --------------------------
+# Fare Engine
+# --------------------------
+def _continues_journey(last, start, start_lat, start_lon, end_lat, end_lon):
+    if last is None:
+        return False
+    last_time, last_lat, last_lon, origin_lat, origin_lon, journey_start, transfers = last
+    if not 0 <= start - last_time <= TRANSFER_WINDOW_MINUTES * 60:
+        return False
+    if transfers >= MAX_TRANSFERS or start - journey_start > MAX_JOURNEY_MINUTES * 60:
+        return False
+    if calculate_distance_km(last_lat, last_lon, start_lat, start_lon) > TRANSFER_RADIUS_KM:
+        return False
+    # Tapping in or out back where the journey began is a return trip, not a connection
+    return (calculate_distance_km(origin_lat, origin_lon, start_lat, start_lon) > TRANSFER_RADIUS_KM
+            and calculate_distance_km(origin_lat, origin_lon, end_lat, end_lon) > TRANSFER_RADIUS_KM)
+
+
+def is_transfer(card_id, trip, end_lat, end_lon):
+    """Whether the trip session `trip`, ending at (end_lat, end_lon), is a connection."""
+    return _continues_journey(get_last_trips().last(card_id), _timestamp(trip["start_time"]),
+                              trip["start_lat"], trip["start_lon"], end_lat, end_lon)
+
+
+def apply_transfer(card_id, trip, fare, end_lat, end_lon):
+    """Discount `fare` if the trip session `trip` is a transfer."""
+    if is_transfer(card_id, trip, end_lat, end_lon):
+        return fare - round(fare * TRANSFER_DISCOUNT)
+    return fare
+
+
+def trip_fare(card_id, trip, end_lat, end_lon):
+    """Distance-banded fare for an open trip session, with transfer rules applied."""
+    distance_km = calculate_distance_km(trip["start_lat"], trip["start_lon"], end_lat, end_lon)
+    return apply_transfer(card_id, trip, get_fare(distance_km), end_lat, end_lon)
+
+
+# --------------------------
+# Fare Quotes
+# --------------------------
+# Quotes ignore transfers (they are per card); they are what a trip
+# between two places costs. Places are snapped first, so a planner asking
+# about the same stations repeatedly only pays for the first lookup.
+@lru_cache(maxsize=QUOTE_CACHE_SIZE)
+def _quote_between(origin, destination):
+    distance_km = calculate_distance_km(origin[1], origin[2], destination[1], destination[2])
+    return round(distance_km, 3), get_fare(distance_km)
+
+
+def _refresh_stations():
+    if stations.refresh():
+        # Station moves change snapped keys and distances
+        _quote_between.cache_clear()
+        fare_matrix.cache_clear()
+
+
+def quote(origin, destination):
+    """Quote one trip between two places ({"station": code} or {"lat": .., "lon": ..})."""
+    _refresh_stations()
+    origin, destination = stations.snap(origin), stations.snap(destination)
+    distance_km, fare = _quote_between(origin, destination)
+    return {
+        "from_station": origin[0],
+        "to_station": destination[0],
+        "distance_km": distance_km,
+        "fare_cents": fare,
+    }
+
+
+def quote_many(pairs):
+    """Quote a batch of {"from": place, "to": place} pairs; bad pairs get an error entry."""
+    quotes = []
+    for pair in pairs:
+        try:
+            quotes.append(quote(pair["from"], pair["to"]))
+        except (KeyError, TypeError, ValueError) as e:
+            quotes.append({"error": f"Invalid pair: {e}"})
+    return quotes
+
+
+def fare_table_version():
+    """ETag for the published fare matrix: changes when stations or fare bands do."""
+    _refresh_stations()
+    return hashlib.sha1(f"{stations.fingerprint}:{FARE_BANDS}".encode()).hexdigest()
+
+
+@lru_cache(maxsize=1)
+def fare_matrix(version):
+    """Full station-to-station fare matrix in cents, built once per version."""
+    points = [stations.snap({"station": code}) for code in stations.codes]
+    return {
+        "version": version,
+        "stations": stations.codes,
+        "fares_cents": [[_quote_between(a, b)[1] for b in points] for a in points],
+    }
+
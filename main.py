@@ -1,147 +1,209 @@
 # main.py
 
-import uuid
+import sys
+import csv
+import json
 import time
-from db import init_db, get_connection
+import uuid
+import argparse
+import bcrypt
+import db
+import archive
+import fares
+from money import to_cents, format_rands
+from db import init_db, unit_of_work, read_only
+from trip_store import active_trips
 
-FARE_FLAT_RATE = 25.0
+FARE_FLAT_RATE = 2500  # cents
 
 # -----------------------------
 # Core Functions
 # -----------------------------
+# Each action is one unit of work; read-only ones take no write lock. Pass
+# `conn` to run it inside a longer transaction (batch mode); results are
+# dicts so both the menu and the batch runner can report them. Amounts are
+# integer cents throughout.
+
+def _result(ok: bool, message: str, **fields):
+    return {"ok": ok, "message": message, **fields}
 
 def generate_card_id() -> str:
     return str(uuid.uuid4())
 
-def register_user(name: str):
-    """Register a new user and save to DB"""
+def register_user(name: str, surname: str, email: str, dob: str, password: str, conn=None):
+    """Register a new user with a virtual card and save to DB"""
     card_id = generate_card_id()
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute("INSERT INTO users (card_id, name, balance, in_trip) VALUES (?, ?, ?, ?)", 
-              (card_id, name, 0.0, 0))
-    conn.commit()
-    conn.close()
-    print(f"[✅] User '{name}' registered. Card ID: {card_id}")
-    return card_id
-
-def load_money(card_id: str, amount: float):
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute("SELECT balance FROM users WHERE card_id = ?", (card_id,))
-    row = c.fetchone()
-    if not row:
-        print("[❌] Card not found.")
-        return
-    new_balance = row[0] + amount
-    c.execute("UPDATE users SET balance = ? WHERE card_id = ?", (new_balance, card_id))
-    conn.commit()
-    conn.close()
-    print(f"[💰] R{amount:.2f} loaded. New balance: R{new_balance:.2f}")
-
-def check_balance(card_id: str):
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute("SELECT name, balance FROM users WHERE card_id = ?", (card_id,))
-    row = c.fetchone()
-    conn.close()
-    if not row:
-        print("[❌] Card not found.")
-    else:
-        print(f"[💳] {row[0]}'s balance: R{row[1]:.2f}")
+    hashed_pw = bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
+    with unit_of_work(conn) as conn:
+        user_id = db.create_user(conn, name, surname, email, dob, hashed_pw, card_id)
+        db.create_virtual_card(conn, user_id, card_id)
+    return _result(True, f"[✅] User '{name}' registered. Card ID: {card_id}", card_id=card_id)
 
-def tap_in(card_id: str):
-    conn = get_connection()
-    c = conn.cursor()
+def load_money(card_id: str, amount: int, conn=None):
+    if amount <= 0:
+        return _result(False, "[❗] Amount must be positive.", card_id=card_id)
+    with unit_of_work(conn) as conn:
+        if not db.get_user_by_card(conn, card_id):
+            return _result(False, "[❌] Card not found.", card_id=card_id)
+        new_balance = db.update_balance(conn, card_id, amount, "topup")
+    return _result(True, f"[💰] {format_rands(amount)} loaded. New balance: {format_rands(new_balance)}",
+                   card_id=card_id, balance_cents=new_balance)
 
-    c.execute("SELECT name, in_trip FROM users WHERE card_id = ?", (card_id,))
-    row = c.fetchone()
+def check_balance(card_id: str, conn=None):
+    with read_only(conn) as conn:
+        row = db.get_user_by_card(conn, card_id)
     if not row:
-        print("[❌] Card not found.")
-        conn.close()
-        return
-    name, in_trip = row
-    if in_trip:
-        print("[⚠️] Already tapped in.")
-        conn.close()
-        return
+        return _result(False, "[❌] Card not found.", card_id=card_id)
+    return _result(True, f"[💳] {row['name']}'s balance: {format_rands(row['balance'])}",
+                   card_id=card_id, balance_cents=row["balance"])
 
-    start_time = time.time()
-    c.execute("INSERT OR REPLACE INTO trip_sessions (card_id, start_time) VALUES (?, ?)", (card_id, start_time))
-    c.execute("UPDATE users SET in_trip = 1 WHERE card_id = ?", (card_id,))
-    conn.commit()
-    conn.close()
-    print(f"[🚌] {name} tapped in.")
-
-def tap_out(card_id: str):
-    conn = get_connection()
-    c = conn.cursor()
-
-    # Validate user and trip status
-    c.execute("SELECT name, balance, in_trip FROM users WHERE card_id = ?", (card_id,))
-    user = c.fetchone()
-    if not user:
-        print("[❌] Card not found.")
-        conn.close()
-        return
-    name, balance, in_trip = user
-    if not in_trip:
-        print("[⚠️] You haven't tapped in.")
-        conn.close()
-        return
-    if balance < FARE_FLAT_RATE:
-        print("[💸] Insufficient funds. Please load more money.")
-        conn.close()
-        return
+def tap_in(card_id: str, lat: float = 0.0, lon: float = 0.0, conn=None):
+    try:
+        lat, lon = fares.parse_point(lat, lon)
+    except ValueError as e:
+        return _result(False, f"[❗] Invalid location: {e}", card_id=card_id)
+    with unit_of_work(conn) as conn:
+        user = db.get_user_by_card(conn, card_id)
+        if not user:
+            return _result(False, "[❌] Card not found.", card_id=card_id)
+        if active_trips.get(card_id, conn):
+            return _result(False, "[⚠️] Already tapped in.", card_id=card_id)
+        active_trips.start(card_id, lat, lon, conn)
+    return _result(True, f"[🚌] {user['name']} tapped in.", card_id=card_id)
 
-    # Get start time and compute trip
-    c.execute("SELECT start_time FROM trip_sessions WHERE card_id = ?", (card_id,))
-    trip = c.fetchone()
-    if not trip:
-        print("[⚠️] No active trip found.")
-        conn.close()
-        return
-    start_time = trip[0]
-    end_time = time.time()
+def tap_out(card_id: str, lat: float = 0.0, lon: float = 0.0, conn=None):
+    try:
+        lat, lon = fares.parse_point(lat, lon)
+    except ValueError as e:
+        return _result(False, f"[❗] Invalid location: {e}", card_id=card_id)
+    with unit_of_work(conn) as conn:
+        # Validate user and trip status
+        user = db.get_user_by_card(conn, card_id)
+        if not user:
+            return _result(False, "[❌] Card not found.", card_id=card_id)
+        trip = active_trips.get(card_id, conn)
+        if not trip:
+            return _result(False, "[⚠️] You haven't tapped in.", card_id=card_id)
+        fare = fares.apply_transfer(card_id, trip, FARE_FLAT_RATE, lat, lon)
+        if user["balance"] < fare:
+            return _result(False, "[💸] Insufficient funds. Please load more money.", card_id=card_id)
 
-    # Log the trip
-    c.execute('''
-        INSERT INTO trip_history (card_id, name, start_time, end_time, fare)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (card_id, name, start_time, end_time, FARE_FLAT_RATE))
+        # Log the trip, deduct the fare and close the session
+        new_balance = db.end_trip(conn, trip, lat, lon, fare, user["id"])
+        active_trips.end(card_id, conn)
 
-    # Deduct fare and reset trip status
-    new_balance = balance - FARE_FLAT_RATE
-    c.execute("UPDATE users SET balance = ?, in_trip = 0 WHERE card_id = ?", (new_balance, card_id))
-    c.execute("DELETE FROM trip_sessions WHERE card_id = ?", (card_id,))
+    fares.record_tap_out(card_id, trip, lat, lon)
+    return _result(True, f"[✅] {user['name']} tapped out. Fare {format_rands(fare)} deducted. "
+                         f"Remaining balance: {format_rands(new_balance)}",
+                   card_id=card_id, fare_cents=fare, balance_cents=new_balance)
 
-    conn.commit()
-    conn.close()
+def view_trip_history(card_id: str, conn=None):
+    with read_only(conn) as conn:
+        user = db.get_user_by_card(conn, card_id)
+        if not user:
+            return _result(False, "[❌] Card not found.", card_id=card_id)
+        trips = list(archive.iter_history(conn, "trip_history", card_id))
 
-    print(f"[✅] {name} tapped out. Fare R{FARE_FLAT_RATE:.2f} deducted. Remaining balance: R{new_balance:.2f}")
+    lines = [f"\n📜 Trip history for {user['name']}:"]
+    if not trips:
+        lines.append("No trips recorded.")
+    for trip in trips:
+        lines.append(f"🕓 {trip['tap_in_time']} → {trip['tap_out_time']} | Fare: {format_rands(trip['fare'])}")
+    return _result(True, "\n".join(lines), card_id=card_id, trips=trips)
 
-def view_trip_history(card_id: str):
-    conn = get_connection()
-    c = conn.cursor()
+# -----------------------------
+# Batch Mode
+# -----------------------------
 
-    c.execute("SELECT name FROM users WHERE card_id = ?", (card_id,))
-    row = c.fetchone()
-    if not row:
-        print("[❌] Card not found.")
-        conn.close()
-        return
-    name = row[0]
+# op name -> (action, argument converters)
+BATCH_OPS = {
+    "register": (register_user, {"name": str, "surname": str, "email": str, "dob": str, "password": str}),
+    "load_money": (load_money, {"card_id": str, "amount": to_cents}),  # amount given in rands
+    "check_balance": (check_balance, {"card_id": str}),
+    "tap_in": (tap_in, {"card_id": str, "lat": float, "lon": float}),
+    "tap_out": (tap_out, {"card_id": str, "lat": float, "lon": float}),
+    "history": (view_trip_history, {"card_id": str}),
+}
 
-    c.execute("SELECT start_time, end_time, fare FROM trip_history WHERE card_id = ? ORDER BY end_time DESC", (card_id,))
-    trips = c.fetchall()
-    conn.close()
+def read_commands(stream, fmt: str):
+    """Yield (command, error) per input record from an NDJSON or CSV stream.
 
-    print(f"\n📜 Trip history for {name}:")
-    if not trips:
-        print("No trips recorded.")
+    CSV needs a header with an `op` column. A line that is not a JSON
+    object yields (None, error) so the batch reports it and carries on.
+    """
+    if fmt == "csv":
+        for row in csv.DictReader(stream):
+            # empty CSV cells mean "not given"
+            yield {key: value for key, value in row.items() if value not in (None, "")}, None
         return
-    for start, end, fare in trips:
-        print(f"🕓 {time.ctime(start)} → {time.ctime(end)} | Fare: R{fare:.2f}")
+    for line in stream:
+        if not line.strip():
+            continue
+        try:
+            command = json.loads(line)
+        except ValueError as e:
+            yield None, f"[❗] Bad JSON: {e}"
+            continue
+        if not isinstance(command, dict):
+            yield None, "[❗] Bad command: expected a JSON object"
+            continue
+        yield command, None
+
+def run_command(conn, command: dict):
+    """Run one command inside its own savepoint so a failure only undoes that command."""
+    op = command.get("op")
+    if op not in BATCH_OPS:
+        return _result(False, f"[❗] Unknown op: {op}")
+    action, params = BATCH_OPS[op]
+    try:
+        kwargs = {name: convert(command[name]) for name, convert in params.items() if name in command}
+    except (ValueError, TypeError, ArithmeticError) as e:
+        return _result(False, f"[❗] Bad argument: {e}")
+
+    mark = len(conn.undo_log)
+    conn.execute("SAVEPOINT batch_command")
+    try:
+        result = action(conn=conn, **kwargs)
+    except Exception as e:
+        conn.undo(mark)  # trip journal changes made by this command
+        conn.execute("ROLLBACK TO batch_command")
+        result = _result(False, f"[❌] {e}")
+    conn.execute("RELEASE batch_command")
+    return result
+
+def run_batch(stream, fmt: str = "ndjson", commit_every: int = 500, out=sys.stdout):
+    """Replay commands over one long-lived connection, committing every `commit_every` commands.
+
+    Prints one JSON result per command and returns a summary dict.
+    """
+    if commit_every < 1:
+        raise ValueError("commit_every must be at least 1")
+    conn = db.connect()
+    started = time.perf_counter()
+    summary = {"commands": 0, "ok": 0, "failed": 0, "commits": 0}
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        for lineno, (command, error) in enumerate(read_commands(stream, fmt), start=1):
+            result = _result(False, error) if error else run_command(conn, command)
+            message = result.pop("message", None)
+            if not result["ok"]:
+                result["error"] = message
+            summary["commands"] += 1
+            summary["ok" if result["ok"] else "failed"] += 1
+            if summary["commands"] % commit_every == 0:
+                conn.commit()
+                summary["commits"] += 1
+                conn.execute("BEGIN IMMEDIATE")
+
+            op = command.get("op") if command else None
+            print(json.dumps({"line": lineno, "op": op, **result}), file=out)
+        conn.commit()
+        summary["commits"] += 1
+    finally:
+        conn.close()
+
+    summary["seconds"] = round(time.perf_counter() - started, 3)
+    return summary
 
 # -----------------------------
 # CLI Menu
@@ -162,23 +224,27 @@ def main_menu():
 
         if choice == "1":
             name = input("Enter name: ")
-            register_user(name)
+            surname = input("Enter surname: ")
+            email = input("Enter email: ")
+            dob = input("Enter date of birth (YYYY-MM-DD): ")
+            password = input("Enter password: ")
+            print(register_user(name, surname, email, dob, password)["message"])
         elif choice == "2":
             card_id = input("Enter Card ID: ")
-            amount = float(input("Enter amount to load: R"))
-            load_money(card_id, amount)
+            amount = to_cents(input("Enter amount to load: R"))
+            print(load_money(card_id, amount)["message"])
         elif choice == "3":
             card_id = input("Enter Card ID: ")
-            check_balance(card_id)
+            print(check_balance(card_id)["message"])
         elif choice == "4":
             card_id = input("Enter Card ID: ")
-            tap_in(card_id)
+            print(tap_in(card_id)["message"])
         elif choice == "5":
             card_id = input("Enter Card ID: ")
-            tap_out(card_id)
+            print(tap_out(card_id)["message"])
         elif choice == "6":
             card_id = input("Enter Card ID: ")
-            view_trip_history(card_id)
+            print(view_trip_history(card_id)["message"])
         elif choice == "0":
             print("👋 Goodbye!")
             break
@@ -189,6 +255,29 @@ def main_menu():
 # Main
 # -----------------------------
 
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Transit Fare System CLI")
+    parser.add_argument("--batch", metavar="FILE",
+                        help="run commands non-interactively from FILE ('-' for stdin)")
+    parser.add_argument("--format", choices=["ndjson", "csv"],
+                        help="batch input format (default: from file extension, else ndjson)")
+    parser.add_argument("--commit-every", type=int, default=500,
+                        help="commit after this many batch commands (default: 500)")
+    args = parser.parse_args(argv)
+    if args.commit_every < 1:
+        parser.error("--commit-every must be at least 1")
+    return args
+
 if __name__ == "__main__":
+    args = parse_args()
     init_db()
-    main_menu()
+    if not args.batch:
+        main_menu()
+    else:
+        fmt = args.format or ("csv" if args.batch.endswith(".csv") else "ndjson")
+        if args.batch == "-":
+            summary = run_batch(sys.stdin, fmt, args.commit_every)
+        else:
+            with open(args.batch, newline="") as f:
+                summary = run_batch(f, fmt, args.commit_every)
+        print(json.dumps(summary), file=sys.stderr)
@@ -0,0 +1,26 @@
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+
+# --------------------------
+# Money
+# --------------------------
+# All amounts are stored and computed as integer cents. Rands only
+# appear at the edges: parsing user input and formatting for display.
+CENT = Decimal("0.01")
+
+
+def to_cents(rands):
+    """Parse a rand amount (str, int, float or Decimal) into integer cents, rounding half up.
+
+    Anything that is not a finite amount raises InvalidOperation (an ArithmeticError).
+    """
+    amount = Decimal(str(rands))
+    if not amount.is_finite():
+        raise InvalidOperation(f"Not a finite amount: {rands}")
+    return int(amount.quantize(CENT, rounding=ROUND_HALF_UP) * 100)
+
+
+def format_rands(cents):
+    """Format integer cents for display, e.g. 1250 -> 'R12.50'."""
+    sign = "-" if cents < 0 else ""
+    rands, cents = divmod(abs(int(cents)), 100)
+    return f"{sign}R{rands}.{cents:02d}"
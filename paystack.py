@@ -0,0 +1,22 @@
+import requests
+from config import PAYSTACK_SECRET_KEY
+
+# Imported lazily by the top-up routes: `requests` is the slowest import
+# in the app and most workers never talk to Paystack.
+PAYSTACK_BASE_URL = 'https://api.paystack.co'
+RequestException = requests.RequestException
+
+
+def _headers():
+    return {
+        'Authorization': f'Bearer {PAYSTACK_SECRET_KEY}',
+        'Content-Type': 'application/json'
+    }
+
+
+def initialize_transaction(data):
+    return requests.post(f'{PAYSTACK_BASE_URL}/transaction/initialize', json=data, headers=_headers())
+
+
+def verify_transaction(reference, timeout=None):
+    return requests.get(f'{PAYSTACK_BASE_URL}/transaction/verify/{reference}', headers=_headers(), timeout=timeout)
@@ -0,0 +1,137 @@
+import os
+import sys
+import time
+import sqlite3
+import threading
+
+import db
+import startup
+from db import DB_NAME
+
+# Read-only copy for reports, history pages and admin scripts
+REPLICA_NAME = os.path.splitext(DB_NAME)[0] + ".replica.db"
+REFRESH_SECONDS = 60
+BACKUP_PAGES = 1024  # pages copied per backup step
+BACKUP_SLEEP = 0.01  # seconds between steps, so WAL checkpoints can run
+BACKUP_RESTARTS = 5  # restarts (source written mid-copy) before copying in one step
+
+
+class _BackupRestarted(Exception):
+    pass
+
+
+# --------------------------
+# Replica Manager
+# --------------------------
+class ReplicaManager:
+    """Keeps a snapshot of the live database refreshed through SQLite's online backup API.
+
+    The snapshot is copied to a temp file in steps of BACKUP_PAGES, each
+    its own short read transaction, and swapped in with os.replace, so
+    readers holding the old file keep a consistent view until they
+    reconnect. Requests never refresh; they read whatever snapshot exists.
+    Freshness comes from the replica's mtime, so every process sharing the
+    file agrees on its age.
+    """
+
+    def __init__(self, source=DB_NAME, path=REPLICA_NAME, interval=REFRESH_SECONDS):
+        self.source = source
+        self.path = path
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._thread = None
+        self.autostart = True  # False where a dedicated process refreshes (serve.py)
+        startup.reset_after_fork(self, reset=self._after_fork)
+
+    def _after_fork(self):
+        self._thread = None
+
+    def _copy(self, src, dst):
+        """Stepped backup; falls back to one step if writes keep restarting it."""
+        remaining = None
+        restarts = 0
+
+        def progress(status, left, total):
+            nonlocal remaining, restarts
+            # A write from another connection restarts the copy from page one
+            if remaining is not None and left > remaining:
+                restarts += 1
+                if restarts > BACKUP_RESTARTS:
+                    raise _BackupRestarted()
+            remaining = left
+
+        try:
+            src.backup(dst, pages=BACKUP_PAGES, progress=progress, sleep=BACKUP_SLEEP)
+        except _BackupRestarted:
+            # Busy database: one read transaction is better than never finishing
+            src.backup(dst)
+
+    def refresh(self):
+        """Take a new snapshot of the source database."""
+        with self._lock:
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            src = db.connect(self.source)
+            dst = sqlite3.connect(tmp_path)
+            try:
+                self._copy(src, dst)
+                # A rollback-journal copy opens cleanly in read-only mode
+                dst.execute("PRAGMA journal_mode=DELETE")
+            finally:
+                dst.close()
+                src.close()
+            os.replace(tmp_path, self.path)
+
+    def age(self):
+        """Seconds since the last snapshot, or None if there is none yet."""
+        try:
+            return time.time() - os.path.getmtime(self.path)
+        except FileNotFoundError:
+            return None
+
+    def connect(self):
+        """Open a read-only connection to the snapshot, whatever its age.
+
+        Until the first snapshot exists this reads the live database
+        read-only instead; a copy is never taken inside the caller's request.
+        """
+        path = self.path if os.path.exists(self.path) else self.source
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    # --------------------------
+    # Background Refresh
+    # --------------------------
+    def start(self):
+        """Refresh every `interval` seconds on a daemon thread (idempotent; no-op without autostart)."""
+        if not self.autostart or (self._thread and self._thread.is_alive()):
+            return
+        self._thread = threading.Thread(target=self.run, name="replica-refresh", daemon=True)
+        self._thread.start()
+
+    def run(self):
+        """Refresh every `interval` seconds in the calling thread, forever."""
+        while True:
+            age = self.age()
+            if age is None or age >= self.interval:
+                try:
+                    self.refresh()
+                except sqlite3.Error as e:
+                    print(f"[⚠️] Replica refresh failed: {e}", file=sys.stderr)
+                age = 0
+            time.sleep(max(1.0, self.interval - age))
+
+
+replica = ReplicaManager()
+
+
+# --------------------------
+# CLI
+# --------------------------
+if __name__ == "__main__":
+    # Usage: python replica.py [--watch]
+    if "--watch" in sys.argv:
+        print(f"[🔁] Refreshing {REPLICA_NAME} every {REFRESH_SECONDS}s")
+        replica.run()
+    replica.refresh()
+    print(f"✅ Replica refreshed: {REPLICA_NAME}")
@@ -0,0 +1,132 @@
+import os
+import sys
+import signal
+import socket
+import argparse
+
+from werkzeug.serving import make_server
+
+import fares
+import startup
+from db import init_db
+from replica import replica
+from trip_store import active_trips
+
+# --------------------------
+# Prefork Server
+# --------------------------
+# The parent loads the app, binds the listening socket and forks one
+# worker per core, plus one process that keeps the replica fresh. Workers accept on the shared socket, so the kernel
+# spreads connections between them. Per-process state (tap guard,
+# last-trip index) moves to the shared SQLite store so every worker
+# sees the same picture; DB connections are already per request.
+THREADED = True  # each worker also serves requests on threads
+BACKLOG = 2048
+REFRESHER = "replica"  # slot of the one process that refreshes the replica
+
+
+def _prepare(app_module):
+    """Everything done once in the parent, before fork (shared copy-on-write)."""
+    with startup.phase("schema check"):
+        init_db()
+    startup.use_shared_state()
+    with startup.phase("last-trip index"):
+        fares.get_last_trips()  # rebuild once, not in every worker
+    with startup.phase("active trips"):
+        # Imports old trip_sessions once; workers reopen the journal after fork
+        len(active_trips)
+    # One dedicated process refreshes the replica, not one thread per worker
+    replica.autostart = False
+    app_module.app.debug = False
+
+
+def _child_signals():
+    # Default signal handling in the child; the parent owns shutdown
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+def _run_refresher():
+    _child_signals()
+    try:
+        replica.run()
+    finally:
+        os._exit(0)
+
+
+def _run_worker(app, sock):
+    _child_signals()
+    host, port = sock.getsockname()[:2]
+    server = make_server(host, port, app, threaded=THREADED, fd=sock.fileno())
+    try:
+        server.serve_forever()
+    finally:
+        os._exit(0)
+
+
+def serve(host="0.0.0.0", port=5000, workers=None):
+    with startup.phase("import app"):
+        import app as app_module  # imported here so `python serve.py --help` stays fast
+
+    workers = workers or os.cpu_count() or 1
+    _prepare(app_module)
+
+    sock = socket.create_server((host, port), backlog=BACKLOG)
+    sock.set_inheritable(True)
+
+    children = {}
+    stopping = False
+
+    def spawn(slot):
+        pid = os.fork()
+        if pid == 0:
+            if slot == REFRESHER:
+                _run_refresher()
+            _run_worker(app_module.app, sock)
+        children[pid] = slot
+
+    def shutdown(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+
+    startup.report()
+    spawn(REFRESHER)
+    for slot in range(workers):
+        spawn(slot)
+    print(f"[🚀] Serving on {host}:{port} with {workers} worker(s), parent pid {os.getpid()}", flush=True)
+
+    # Supervise: respawn workers that die until asked to stop
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        slot = children.pop(pid, None)
+        if not stopping and slot is not None:
+            name = "Replica refresher" if slot == REFRESHER else "Worker"
+            print(f"[⚠️] {name} {pid} exited ({status}), respawning", file=sys.stderr, flush=True)
+            spawn(slot)
+
+    sock.close()
+
+
+# --------------------------
+# Main
+# --------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Production prefork server for the transit fare app")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: CPU count)")
+    args = parser.parse_args()
+    serve(args.host, args.port, args.workers)
@@ -0,0 +1,133 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from db import DB_NAME, BUSY_TIMEOUT
+
+# Small key/value store shared by every worker process on the host.
+# Kept out of the main database so cache and rate-limit churn never
+# competes with taps for its write lock.
+STATE_DB_NAME = os.path.splitext(DB_NAME)[0] + ".state.db"
+PURGE_EVERY = 1000  # writes between sweeps of expired keys
+
+
+# --------------------------
+# Shared State Store
+# --------------------------
+class SharedState:
+    """SQLite-backed key/value store with per-key expiry, safe across fork and threads.
+
+    Values are JSON. Each thread of each process gets its own connection,
+    opened lazily, so a store created before fork() is safe to use in the
+    children.
+    """
+
+    def __init__(self, path=STATE_DB_NAME):
+        self.path = path
+        self._local = threading.local()
+        self._writes = 0
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")  # losing the last writes on power loss is fine here
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS kv (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    expires_at REAL
+                ) WITHOUT ROWID
+            """)
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def _wrote(self):
+        self._writes += 1
+        if self._writes % PURGE_EVERY == 0:
+            self.purge()
+
+    def get(self, key, default=None):
+        row = self._conn().execute(
+            "SELECT value FROM kv WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (key, time.time()),
+        ).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.time() + ttl if ttl else None
+        self._conn().execute(
+            "INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, json.dumps(value), expires_at),
+        )
+        self._wrote()
+
+    @contextmanager
+    def transaction(self):
+        """Make the operations inside the block one atomic write."""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield self
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def set_many(self, items, ttl=None):
+        """Bulk set from (key, value) pairs in one transaction."""
+        expires_at = time.time() + ttl if ttl else None
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+                ((key, json.dumps(value), expires_at) for key, value in items),
+            )
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def add(self, key, value, ttl=None):
+        """Set `key` only if it is absent or expired. Returns True if this call set it."""
+        now = time.time()
+        cur = self._conn().execute("""
+            INSERT INTO kv (key, value, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at
+            WHERE kv.expires_at IS NOT NULL AND kv.expires_at <= ?
+        """, (key, json.dumps(value), now + ttl if ttl else None, now))
+        self._wrote()
+        return cur.rowcount == 1
+
+    def incr(self, key, delta=1, ttl=None):
+        """Atomically add `delta` to a numeric key and return the new value.
+
+        An expired key restarts from zero; `ttl` only applies when the key is created.
+        """
+        now = time.time()
+        row = self._conn().execute("""
+            INSERT INTO kv (key, value, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET
+                value = CASE WHEN kv.expires_at IS NOT NULL AND kv.expires_at <= ?
+                             THEN excluded.value ELSE kv.value + ? END,
+                expires_at = CASE WHEN kv.expires_at IS NOT NULL AND kv.expires_at <= ?
+                                  THEN excluded.expires_at ELSE kv.expires_at END
+            RETURNING value
+        """, (key, delta, now + ttl if ttl else None, now, delta, now)).fetchone()
+        self._wrote()
+        return json.loads(str(row[0]))
+
+    def delete(self, key):
+        self._conn().execute("DELETE FROM kv WHERE key = ?", (key,))
+
+    def purge(self):
+        """Drop expired keys."""
+        self._conn().execute("DELETE FROM kv WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(),))
+
+
+state = SharedState()
@@ -0,0 +1,81 @@
+import os
+import sys
+import time
+import threading
+from contextlib import contextmanager
+
+# --------------------------
+# Startup Phase Timing
+# --------------------------
+# Entry points wrap their import/setup steps in phase() and print the
+# report once serving starts, so slow imports show up in the logs.
+_started = time.perf_counter()
+phases = []  # (name, seconds)
+
+
+@contextmanager
+def phase(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        phases.append((name, time.perf_counter() - start))
+
+
+def report(file=sys.stderr):
+    for name, seconds in phases:
+        print(f"[⏱️] {name:<24} {seconds * 1000:8.1f} ms", file=file)
+    print(f"[⏱️] {'total since start':<24} {(time.perf_counter() - _started) * 1000:8.1f} ms", file=file, flush=True)
+
+
+# --------------------------
+# Multi-process State
+# --------------------------
+def use_shared_state():
+    """Move the tap guard, last-trip index and event bus to the shared store.
+
+    Every process that takes taps next to others (prefork workers, the
+    tap server) calls this before serving, so duplicate taps, transfers
+    and events seen by one are seen by all.
+    """
+    import fares
+    import events
+    import tap_guard
+    from shared_state import state
+    tap_guard.use_shared_state(state)
+    fares.use_shared_state(state)
+    events.use_shared_state(state)
+
+
+def reset_after_fork(obj, lock="_lock", reset=None):
+    """Give `obj` a new lock, then call `reset()`, in every forked child.
+
+    Only the thread that called fork survives in the child. A lock another
+    thread held at that moment would stay locked forever, and threads the
+    object started are gone; `reset` forgets those and anything else the
+    child must not share with its parent.
+    """
+    def child():
+        setattr(obj, lock, threading.Lock())
+        if reset is not None:
+            reset()
+    os.register_at_fork(after_in_child=child)
+
+
+# --------------------------
+# Background Warm-up
+# --------------------------
+def _warm():
+    import fares
+    from trip_store import active_trips
+    with phase("warm: last-trip index"):
+        fares.get_last_trips()
+    with phase("warm: active trips"):
+        len(active_trips)  # load the checkpoint and replay the journal
+
+
+def warm_caches():
+    """Build in-memory caches on a daemon thread so the first tap doesn't pay for them."""
+    thread = threading.Thread(target=_warm, name="warm-caches", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,25 @@
+// Live balance and trip updates pushed by the server (/events).
+// Include with data-stream set to the stream URL; the page needs
+// #balance and #activity elements.
+(function () {
+  const rands = cents => "R" + (cents / 100).toFixed(2);
+  const stream = new EventSource(document.currentScript.dataset.stream);
+  // Tap-outs and top-ups carry the new balance, so each action is one event
+  const showBalance = data => {
+    if (data.balance_cents !== undefined) {
+      document.getElementById("balance").textContent = rands(data.balance_cents);
+    }
+  };
+  stream.addEventListener("balance", e => showBalance(JSON.parse(e.data)));
+  stream.addEventListener("tap", e => {
+    const tap = JSON.parse(e.data);
+    const text = tap.action === "in" ? "Tapped in" : "Tapped out, fare " + rands(tap.fare_cents);
+    document.getElementById("activity").textContent = "🚏 " + text;
+    showBalance(tap);
+  });
+  stream.addEventListener("topup", e => {
+    const topup = JSON.parse(e.data);
+    document.getElementById("activity").textContent = "💳 Top-up of " + rands(topup.amount_cents) + " received";
+    showBalance(topup);
+  });
+})();
@@ -0,0 +1,117 @@
+import csv
+import sys
+import time
+import hashlib
+import threading
+
+import db
+from db import unit_of_work
+
+SNAP_RADIUS_KM = 0.3        # a coordinate this close to a station is that station
+GRID_DEGREES = 0.01         # station lookup buckets (~1.1 km)
+POINT_DECIMALS = 3          # off-station points snap to a ~100 m grid
+REFRESH_SECONDS = 300       # how often the station list is re-read
+
+
+# --------------------------
+# Station Index
+# --------------------------
+class StationIndex:
+    """Stations in memory, bucketed on a lat/lon grid for nearest-station lookups."""
+
+    def __init__(self):
+        self.by_code = {}
+        self.codes = []
+        self.fingerprint = None
+        self.loaded_at = 0.0
+        self._grid = {}
+        self._lock = threading.Lock()
+
+    def _load(self, conn):
+        rows = conn.execute("SELECT code, name, lat, lon FROM stations ORDER BY code").fetchall()
+        digest = hashlib.sha1()
+        by_code, grid = {}, {}
+        for row in rows:
+            station = dict(row)
+            by_code[station["code"]] = station
+            grid.setdefault(self._cell(station["lat"], station["lon"]), []).append(station)
+            digest.update(repr(tuple(row)).encode())
+        self.by_code, self.codes, self._grid = by_code, [row["code"] for row in rows], grid
+        self.fingerprint = digest.hexdigest()
+        self.loaded_at = time.time()
+
+    def refresh(self, conn=None):
+        """Re-read stations if the list is older than REFRESH_SECONDS. Returns True if it changed."""
+        if time.time() - self.loaded_at < REFRESH_SECONDS:
+            return False
+        with self._lock:
+            if time.time() - self.loaded_at < REFRESH_SECONDS:
+                return False
+            before = self.fingerprint
+            if conn is None:
+                with db.get_connection() as conn:
+                    self._load(conn)
+            else:
+                self._load(conn)
+            return self.fingerprint != before
+
+    @staticmethod
+    def _cell(lat, lon):
+        return int(lat // GRID_DEGREES), int(lon // GRID_DEGREES)
+
+    def nearest(self, lat, lon):
+        """Closest station within SNAP_RADIUS_KM, or None."""
+        from fares import calculate_distance_km
+
+        row, col = self._cell(lat, lon)
+        best, best_km = None, SNAP_RADIUS_KM
+        for d_row in (-1, 0, 1):
+            for d_col in (-1, 0, 1):
+                for station in self._grid.get((row + d_row, col + d_col), ()):
+                    km = calculate_distance_km(lat, lon, station["lat"], station["lon"])
+                    if km <= best_km:
+                        best, best_km = station, km
+        return best
+
+    def snap(self, place):
+        """Turn {"station": code} or {"lat": .., "lon": ..} into a hashable (code, lat, lon) key.
+
+        Off-station points get code None and coordinates rounded to
+        POINT_DECIMALS, so nearby requests share memoized quotes.
+        """
+        if "station" in place:
+            station = self.by_code.get(place["station"])
+            if station is None:
+                raise ValueError(f"Unknown station: {place['station']}")
+            return station["code"], station["lat"], station["lon"]
+
+        lat, lon = float(place["lat"]), float(place["lon"])
+        station = self.nearest(lat, lon)
+        if station is not None:
+            return station["code"], station["lat"], station["lon"]
+        return None, round(lat, POINT_DECIMALS), round(lon, POINT_DECIMALS)
+
+
+stations = StationIndex()
+
+
+# --------------------------
+# Import
+# --------------------------
+def import_csv(path):
+    """Load or update stations from a CSV with code,name,lat,lon columns."""
+    with open(path, newline="") as f:
+        rows = [(r["code"], r["name"], float(r["lat"]), float(r["lon"])) for r in csv.DictReader(f)]
+    with unit_of_work() as conn:
+        conn.executemany("""
+            INSERT INTO stations (code, name, lat, lon) VALUES (?, ?, ?, ?)
+            ON CONFLICT(code) DO UPDATE SET name = excluded.name, lat = excluded.lat, lon = excluded.lon
+        """, rows)
+    return len(rows)
+
+
+if __name__ == "__main__":
+    # Usage: python stations.py stations.csv
+    if len(sys.argv) != 2:
+        sys.exit("Usage: python stations.py stations.csv")
+    print(f"✅ {import_csv(sys.argv[1])} stations imported.")
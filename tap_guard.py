@@ -0,0 +1,162 @@
+import time
+import threading
+
+import startup
+
+# Readers repeat a tap within about a second; anything from the same
+# device inside this window is the same physical tap.
+DEBOUNCE_SECONDS = 1.5
+
+# Token bucket per card: bursts of BUCKET_CAPACITY taps, then one tap
+# every 1/BUCKET_REFILL_PER_SECOND seconds.
+BUCKET_CAPACITY = 5
+BUCKET_REFILL_PER_SECOND = 1 / 6
+
+# Memory bounds: idle cards leave the table after ENTRY_TTL_SECONDS (the
+# time a drained bucket takes to refill) and never more than MAX_CARDS are tracked.
+ENTRY_TTL_SECONDS = max(DEBOUNCE_SECONDS, BUCKET_CAPACITY / BUCKET_REFILL_PER_SECOND)
+WHEEL_SLOTS = 64  # one-second slots, must exceed ENTRY_TTL_SECONDS
+MAX_CARDS = 200_000
+
+DUPLICATE = "duplicate"
+RATE_LIMITED = "rate_limited"
+
+
+class _CardState:
+    __slots__ = ("device_id", "seen", "tokens", "expires")
+
+    def __init__(self, now):
+        self.device_id = None
+        self.seen = 0.0
+        self.tokens = float(BUCKET_CAPACITY)
+        self.expires = now
+
+
+class TapGuard:
+    """Reject repeated reads and tap floods before any SQL runs.
+
+    Per-card steps run without locks: each is a single dict/set operation,
+    atomic under the GIL. Two threads racing on the same card can both be
+    let through, which is fine because the tap itself is transactional.
+    Expiry uses a time wheel, so each check costs O(1) amortised; only
+    turning the wheel takes a lock, at most once a second.
+    """
+
+    def __init__(self):
+        self._cards = {}
+        self._wheel = [set() for _ in range(WHEEL_SLOTS)]
+        self._tick = int(time.monotonic())
+        self._advance_lock = threading.Lock()
+        self.counters = {"allowed": 0, DUPLICATE: 0, RATE_LIMITED: 0, "expired": 0}
+        startup.reset_after_fork(self, lock="_advance_lock")
+
+    def __len__(self):
+        return len(self._cards)
+
+    def check(self, card_id, device_id=None, now=None):
+        """Return None if the tap may proceed, otherwise DUPLICATE or RATE_LIMITED."""
+        now = time.monotonic() if now is None else now
+        self._advance(now)
+
+        state = self._cards.get(card_id)
+        if state is None:
+            if len(self._cards) >= MAX_CARDS:
+                self._sweep(now)
+                if len(self._cards) >= MAX_CARDS:
+                    # Table full of live cards: fail open rather than grow
+                    self.counters["allowed"] += 1
+                    return None
+            state = self._cards.setdefault(card_id, _CardState(now))
+
+        if device_id == state.device_id and now - state.seen < DEBOUNCE_SECONDS:
+            self.counters[DUPLICATE] += 1
+            return DUPLICATE
+
+        # Refill the bucket for the time since the last tap
+        state.tokens = min(BUCKET_CAPACITY, state.tokens + (now - state.seen) * BUCKET_REFILL_PER_SECOND)
+        state.device_id = device_id
+        state.seen = now
+        self._schedule(card_id, state, now)
+
+        if state.tokens < 1:
+            self.counters[RATE_LIMITED] += 1
+            return RATE_LIMITED
+        state.tokens -= 1
+        self.counters["allowed"] += 1
+        return None
+
+    def stats(self):
+        return {"tracked_cards": len(self._cards), **self.counters}
+
+    # --------------------------
+    # Time Wheel
+    # --------------------------
+    def _schedule(self, card_id, state, now):
+        state.expires = now + ENTRY_TTL_SECONDS
+        # The slot after `expires`, so the entry is past due when its slot comes up
+        self._wheel[(int(state.expires) + 1) % WHEEL_SLOTS].add(card_id)
+
+    def _advance(self, now):
+        """Expire the slots the clock has moved past since the last call."""
+        target = int(now)
+        if target <= self._tick:
+            return  # same second: nothing to turn, no lock taken
+        # Read-modify-write of _tick: two threads turning at once would skip slots
+        with self._advance_lock:
+            # After a full turn every slot has been cleared, so skip ahead
+            if target - self._tick > WHEEL_SLOTS:
+                self._tick = target - WHEEL_SLOTS
+            while self._tick < target:
+                self._tick += 1
+                index = self._tick % WHEEL_SLOTS
+                due, self._wheel[index] = self._wheel[index], set()
+                for card_id in due:
+                    self._expire(card_id, now)
+
+    def _expire(self, card_id, now):
+        state = self._cards.get(card_id)
+        # A card touched again since it was scheduled lives in a later slot
+        if state is not None and state.expires <= now:
+            if self._cards.pop(card_id, None) is not None:
+                self.counters["expired"] += 1
+
+    def _sweep(self, now):
+        """Full scan used only when the table is at MAX_CARDS."""
+        for card_id in list(self._cards):
+            self._expire(card_id, now)
+
+
+class SharedTapGuard:
+    """TapGuard for multi-process deployments, keeping its state in a SharedState store.
+
+    Debounce keys expire after DEBOUNCE_SECONDS; the bucket becomes a
+    counter over a window of ENTRY_TTL_SECONDS with the same sustained rate.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def check(self, card_id, device_id=None, now=None):
+        if not self.store.add(f"tap:seen:{card_id}:{device_id}", 1, ttl=DEBOUNCE_SECONDS):
+            return self._count(DUPLICATE)
+        if self.store.incr(f"tap:rate:{card_id}", ttl=ENTRY_TTL_SECONDS) > BUCKET_CAPACITY:
+            return self._count(RATE_LIMITED)
+        self._count("allowed")
+        return None
+
+    def _count(self, outcome):
+        self.store.incr(f"tap:count:{outcome}")
+        return None if outcome == "allowed" else outcome
+
+    def stats(self):
+        return {outcome: self.store.get(f"tap:count:{outcome}", 0)
+                for outcome in ("allowed", DUPLICATE, RATE_LIMITED)}
+
+
+guard = TapGuard()
+
+
+def use_shared_state(store):
+    """Switch the process-wide guard to shared state (call before forking workers)."""
+    global guard
+    guard = SharedTapGuard(store)
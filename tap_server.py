@@ -0,0 +1,181 @@
+import sys
+import json
+import struct
+import asyncio
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+import taps
+import startup
+import tap_guard
+from db import init_db
+
+# --------------------------
+# Protocol
+# --------------------------
+# Every frame is a 4-byte big-endian length followed by a UTF-8 JSON body.
+#   request:  {"id": 7, "card_id": "CARD-1234ABCD", "latitude": -26.2, "longitude": 28.0}
+#   response: {"id": 7, "status": 200, "message": "...", "balance_cents": 3800, "fare_cents": 1200}
+# Validators keep one connection open and may pipeline many requests on it;
+# responses always come back in request order.
+HEADER = struct.Struct(">I")
+MAX_FRAME = 64 * 1024
+MAX_PIPELINE = 32  # in-flight requests per connection before we stop reading
+_CLOSED = object()  # read_frame result for a closed connection (a JSON null body is None)
+
+
+def encode_frame(message):
+    body = json.dumps(message, separators=(",", ":")).encode()
+    return HEADER.pack(len(body)) + body
+
+
+async def read_frame(reader, closed=None):
+    """Return the next decoded frame, or `closed` when the peer closed the connection."""
+    try:
+        header = await reader.readexactly(HEADER.size)
+    except asyncio.IncompleteReadError:
+        return closed
+    (length,) = HEADER.unpack(header)
+    if length > MAX_FRAME:
+        raise ValueError(f"Frame of {length} bytes exceeds {MAX_FRAME}")
+    return json.loads(await reader.readexactly(length))
+
+
+# --------------------------
+# SQLite Executor
+# --------------------------
+# SQLite has one writer at a time, so all tap work runs on a single
+# dedicated thread holding one long-lived connection. The event loop never
+# blocks on disk and never contends with itself for the write lock.
+_local = threading.local()
+
+
+def _open_connection():
+    _local.conn = db.connect()
+
+
+def _rejection(request, peer):
+    """The 429 response if the tap guard drops this request, else None."""
+    card_id = request.get("card_id")
+    rejected = card_id and tap_guard.guard.check(card_id, request.get("device_id") or peer)
+    if not rejected:
+        return None
+    return {"id": request.get("id"), "status": 429, "reason": rejected,
+            "message": "⏳ Duplicate tap ignored" if rejected == "duplicate" else "⏳ Too many taps, slow down"}
+
+
+def _guarded_tap(request, peer):
+    return _rejection(request, peer) or _handle_tap(request)
+
+
+def _handle_tap(request):
+    payload, status = taps.nfc_tap(
+        _local.conn,
+        request.get("card_id"),
+        request.get("latitude", 0.0),
+        request.get("longitude", 0.0),
+    )
+    return {"id": request.get("id"), "status": status, **payload}
+
+
+def _answered(loop, response):
+    """A future already holding `response`, for answers that need no SQLite work."""
+    future = loop.create_future()
+    future.set_result(response)
+    return future
+
+
+def make_executor():
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite", initializer=_open_connection)
+
+
+# --------------------------
+# Server
+# --------------------------
+class TapServer:
+    def __init__(self, executor=None):
+        self.executor = executor or make_executor()
+        self.connections = 0
+
+    async def handle_connection(self, reader, writer):
+        self.connections += 1
+        loop = asyncio.get_running_loop()
+        peer = writer.get_extra_info("peername")
+        pending = asyncio.Queue(MAX_PIPELINE)  # futures in request order
+        sender = asyncio.create_task(self._send_responses(pending, writer))
+        try:
+            while True:
+                try:
+                    request = await read_frame(reader, closed=_CLOSED)
+                except (ValueError, asyncio.IncompleteReadError):
+                    break  # malformed or truncated frame: drop the connection
+                if request is _CLOSED:
+                    break
+                if not isinstance(request, dict):
+                    # Valid JSON but not a request: answer it and keep the connection
+                    response = {"status": 400, "message": "❌ Request must be a JSON object"}
+                    await pending.put(_answered(loop, response))
+                    continue
+                # put() blocks once MAX_PIPELINE requests are in flight
+                await pending.put(self._dispatch(loop, request, peer))
+        except ConnectionError:
+            pass
+        finally:
+            await pending.put(None)
+            await sender
+            writer.close()
+            self.connections -= 1
+
+    def _dispatch(self, loop, request, peer):
+        """Answer duplicates straight from the event loop; send real taps to SQLite."""
+        if isinstance(tap_guard.guard, tap_guard.SharedTapGuard):
+            # The shared guard writes to SQLite too, so it must stay off the event loop
+            return loop.run_in_executor(self.executor, _guarded_tap, request, peer)
+        rejected = _rejection(request, peer)
+        if rejected:
+            return _answered(loop, rejected)
+        return loop.run_in_executor(self.executor, _handle_tap, request)
+
+    async def _send_responses(self, pending, writer):
+        while True:
+            future = await pending.get()
+            if future is None:
+                return
+            try:
+                response = await future
+            except Exception as e:
+                response = {"status": 500, "message": f"❌ {e}"}
+            try:
+                writer.write(encode_frame(response))
+                await writer.drain()
+            except ConnectionError:
+                pass
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle_connection, host, port, backlog=4096)
+        print(f"[🚏] Tap server listening on {host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+
+# --------------------------
+# Main
+# --------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Persistent-connection tap server for validators")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5001)
+    args = parser.parse_args()
+
+    with startup.phase("schema check"):
+        init_db()
+    # Separate process from the web workers: share their tap guard, transfers and events
+    startup.use_shared_state()
+    startup.warm_caches()
+    startup.report()
+    try:
+        asyncio.run(TapServer().serve(args.host, args.port))
+    except KeyboardInterrupt:
+        sys.exit(0)
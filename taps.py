@@ -0,0 +1,56 @@
+import db
+import fares
+import events
+from money import format_rands
+from db import unit_of_work
+from trip_store import active_trips
+
+NFC_FLAT_FARE = 1200  # Flat rate in cents
+
+
+# --------------------------
+# Tap Handling
+# --------------------------
+# Shared by the Flask /nfc_tap route and the asyncio tap server, so both
+# front ends apply exactly the same rules. Returns (payload, status) where
+# status follows HTTP codes. Money fields are integer cents.
+def nfc_tap(conn, card_id, lat=0.0, lon=0.0):
+    """Tap a card in, or out if it already has an open trip."""
+    if not card_id:
+        return {"message": "❌ No card ID provided"}, 400
+    try:
+        lat, lon = fares.parse_point(lat, lon)
+    except ValueError as e:
+        return {"message": f"❌ Invalid location: {e}"}, 400
+
+    with unit_of_work(conn):
+        user = db.get_user_by_card(conn, card_id)
+        if not user:
+            return {"message": "❌ Card not recognized"}, 404
+
+        trip = active_trips.get(card_id)
+        if not trip:
+            # Tap-in: Start trip
+            active_trips.start(card_id, lat, lon, conn)
+        else:
+            # Tap-out: Complete trip
+            fare = fares.apply_transfer(card_id, trip, NFC_FLAT_FARE, lat, lon)
+            if user["balance"] < fare:
+                return {
+                    "message": f"❌ Insufficient balance for {user['name']} ({format_rands(user['balance'])}). "
+                               f"Fare is {format_rands(fare)}"
+                }, 400
+
+            new_balance = db.end_trip(conn, trip, lat, lon, fare, user["id"])
+            # Closed before commit (reopened if the transaction rolls back):
+            # a crash in between loses the trip rather than charging twice
+            active_trips.end(card_id, conn)
+
+    # Subscribers only hear about committed taps
+    if not trip:
+        events.publish(card_id, events.TAP, action="in", lat=lat, lon=lon)
+        return {"message": f"✅ Tap-In Successful for {user['name']}", "balance_cents": user["balance"]}, 200
+
+    fares.record_tap_out(card_id, trip, lat, lon)
+    events.publish(card_id, events.TAP, action="out", lat=lat, lon=lon, fare_cents=fare, balance_cents=new_balance)
+    return {"message": f"✅ Tap-Out Successful for {user['name']}", "balance_cents": new_balance, "fare_cents": fare}, 200
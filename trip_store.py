@@ -0,0 +1,318 @@
+import os
+import sys
+import json
+import fcntl
+import threading
+from datetime import datetime
+
+import db
+import startup
+from db import DB_NAME
+
+# Files live next to the database:
+#   <base>.trips.lock            flock serializing journal appends across processes
+#   <base>.trips.checkpoint      header line {"gen", "count"} then one open trip per line
+#   <base>.trips.<gen>.journal   ops since that checkpoint, one JSON array per line
+TRIPS_BASE = os.path.splitext(DB_NAME)[0] + ".trips"
+CHECKPOINT_BYTES = 4 * 1024 * 1024  # journal size that triggers a checkpoint
+FSYNC = True  # flush every append to disk; a tap is not acknowledged before it is durable
+_UNSTAGED = object()  # no staged change for the card
+
+
+# --------------------------
+# Trip Records
+# --------------------------
+class TripRecord:
+    """An open trip. Indexable like the old trip_sessions rows (trip["start_lat"])."""
+
+    __slots__ = ("card_id", "start_time", "start_lat", "start_lon")
+
+    def __init__(self, card_id, start_time, start_lat, start_lon):
+        self.card_id = card_id
+        self.start_time = start_time
+        self.start_lat = start_lat
+        self.start_lon = start_lon
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def as_list(self):
+        return [self.card_id, self.start_time, self.start_lat, self.start_lon]
+
+
+def _iso_time(value):
+    """ISO start time; the old CLI stored time.time() in trip_sessions instead."""
+    try:
+        return datetime.fromtimestamp(float(value)).isoformat()
+    except (TypeError, ValueError):
+        return value
+
+
+# --------------------------
+# Active Trip Store
+# --------------------------
+class ActiveTripStore:
+    """Authoritative table of open trips: a dict of TripRecords backed by a journal.
+
+    Every change is appended to the journal under an flock, after first
+    replaying whatever other processes appended since this one last
+    looked, so all workers and the tap server share one picture. Reads
+    do the same catch-up; when nothing changed it costs one fstat.
+
+    Once the journal passes CHECKPOINT_BYTES the whole table is written to
+    a new checkpoint and a fresh journal generation begins; other
+    processes notice the replaced checkpoint file and reload from it.
+    Startup loads the checkpoint and replays one journal.
+    """
+
+    def __init__(self, base=TRIPS_BASE):
+        self.base = base
+        self.trips = {}
+        self._staged = {}  # connection -> {card_id: TripRecord or None} waiting for its commit
+        self._opened = False
+        self._lock = threading.Lock()
+        startup.reset_after_fork(self, reset=self._after_fork)
+
+    def _after_fork(self):
+        # flock belongs to the open file description, which fork shares: reopen
+        if self._opened:
+            os.close(self._lock_fd)
+            os.close(self._journal_fd)
+            self._opened = False
+
+    # --------------------------
+    # Files
+    # --------------------------
+    @staticmethod
+    def _file_id(st):
+        # Inode numbers get reused once the old checkpoint is gone; mtime tells them apart
+        return st.st_ino, st.st_mtime_ns
+
+    def _journal_path(self, gen):
+        return f"{self.base}.{gen}.journal"
+
+    def _open(self):
+        """Open the lock file and load state (caller holds the flock)."""
+        self._lock_fd = os.open(self.base + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+        try:
+            if not os.path.exists(self.base + ".checkpoint"):
+                self._import_trip_sessions()
+            self._load()
+        finally:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+        self._opened = True
+
+    def _load(self):
+        """Read the checkpoint and replay its journal (caller holds the flock)."""
+        trips = {}
+        with open(self.base + ".checkpoint") as f:
+            self._checkpoint_id = self._file_id(os.fstat(f.fileno()))
+            self.gen = json.loads(f.readline())["gen"]
+            for line in f:
+                record = TripRecord(*json.loads(line))
+                trips[record.card_id] = record
+        self.trips = trips
+        self._journal_fd = os.open(self._journal_path(self.gen), os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self._offset = 0
+        self._catch_up()
+
+    def _write_checkpoint(self, gen, trips):
+        tmp_path = self.base + ".checkpoint.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(json.dumps({"gen": gen, "count": len(trips)}) + "\n")
+            for record in trips:
+                f.write(json.dumps(record.as_list()) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        # New journal first, so the checkpoint never names a missing file
+        # (truncated: one left by a crash at this point never saw an append)
+        os.close(os.open(self._journal_path(gen), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644))
+        os.replace(tmp_path, self.base + ".checkpoint")
+        dir_fd = os.open(os.path.dirname(os.path.abspath(self.base)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    def _import_trip_sessions(self):
+        """First start: copy any open sessions from the old trip_sessions table.
+
+        Read only: the first open usually happens inside a tap's write
+        transaction, so taking the write lock here would wait on ourselves.
+        The rows are left behind; nothing reads them once a checkpoint exists.
+        """
+        conn = db.connect()
+        try:
+            rows = conn.execute("SELECT card_id, start_time, start_lat, start_lon FROM trip_sessions ORDER BY id").fetchall()
+        finally:
+            conn.close()
+        # Later rows win, as get_active_trip used to pick the newest session
+        trips = {row["card_id"]: TripRecord(row["card_id"], _iso_time(row["start_time"]), row["start_lat"], row["start_lon"])
+                 for row in rows}
+        self._write_checkpoint(1, trips.values())
+
+    # --------------------------
+    # Journal
+    # --------------------------
+    def _apply(self, op):
+        kind = op[0]
+        if kind == "in":
+            record = TripRecord(*op[1:])
+            self.trips[record.card_id] = record
+        elif kind == "out":
+            self.trips.pop(op[1], None)
+
+    def _catch_up(self):
+        """Replay journal ops appended since our last read (caller holds the flock)."""
+        size = os.fstat(self._journal_fd).st_size
+        if size == self._offset:
+            return
+        data = os.pread(self._journal_fd, size - self._offset, self._offset)
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            # A torn final line from a crashed writer: nobody else is writing, cut it off
+            os.ftruncate(self._journal_fd, self._offset + end)
+        for line in data[:end].splitlines():
+            self._apply(json.loads(line))
+        self._offset += end
+
+    def _append(self, *ops):
+        data = "".join(json.dumps(op, separators=(",", ":")) + "\n" for op in ops)
+        os.write(self._journal_fd, data.encode())
+        if FSYNC:
+            os.fdatasync(self._journal_fd)
+        self._offset = os.fstat(self._journal_fd).st_size
+
+    def _checkpoint(self):
+        old_path = self._journal_path(self.gen)
+        self._write_checkpoint(self.gen + 1, self.trips.values())
+        os.close(self._journal_fd)
+        self._load()
+        # Everyone else reloads from the new checkpoint, so the old journal is dead
+        os.remove(old_path)
+
+    def _locked(self, fn):
+        with self._lock:
+            if not self._opened:
+                self._open()
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+            try:
+                if self._file_id(os.stat(self.base + ".checkpoint")) != self._checkpoint_id:
+                    # Another process checkpointed: its file holds everything up to now
+                    os.close(self._journal_fd)
+                    self._load()
+                else:
+                    self._catch_up()
+                result = fn()
+                if self._offset >= CHECKPOINT_BYTES:
+                    self._checkpoint()
+                return result
+            finally:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    # --------------------------
+    # Operations
+    # --------------------------
+    # Given the caller's database connection (a db.Connection), start and
+    # end only stage the change: it is journaled just before that
+    # transaction commits, in one append, and dropped if it rolls back.
+    # get with the same connection sees the staged changes. Without a
+    # connection the change is journaled at once.
+    def get(self, card_id, conn=None):
+        """The card's open trip, or None."""
+        staged = self._staged.get(conn)
+        if staged and card_id in staged:
+            return staged[card_id]
+        return self._locked(lambda: self.trips.get(card_id))
+
+    def start(self, card_id, lat, lon, conn=None):
+        """Open a trip, replacing any trip left open on the card."""
+        record = TripRecord(card_id, datetime.now().isoformat(), lat, lon)
+        if conn is not None:
+            self._stage(conn, card_id, record)
+            return record
+
+        def op():
+            self._append(["in", *record.as_list()])
+            self.trips[card_id] = record
+        self._locked(op)
+        return record
+
+    def end(self, card_id, conn=None):
+        """Close the card's open trip and return it (None if there was none)."""
+        if conn is not None:
+            record = self.get(card_id, conn)
+            if record is not None:
+                self._stage(conn, card_id, None)
+            return record
+
+        def op():
+            record = self.trips.pop(card_id, None)
+            if record is not None:
+                self._append(["out", card_id])
+            return record
+        return self._locked(op)
+
+    def _stage(self, conn, card_id, record):
+        staged = self._staged.get(conn)
+        if staged is None:
+            staged = self._staged[conn] = {}
+            conn.before_commit(lambda: self._flush(conn))
+            conn.on_rollback(lambda: self._staged.pop(conn, None))
+        previous = staged.get(card_id, _UNSTAGED)
+        staged[card_id] = record
+
+        def unstage():
+            if previous is _UNSTAGED:
+                staged.pop(card_id, None)
+            else:
+                staged[card_id] = previous
+        conn.on_rollback(unstage)
+
+    def _flush(self, conn):
+        """Journal a connection's staged changes (runs just before it commits)."""
+        staged = self._staged.pop(conn, None)
+        if not staged:
+            return
+
+        def op():
+            previous = {card_id: self.trips.get(card_id) for card_id in staged}
+            self._restore(staged)
+            return previous
+        previous = self._locked(op)
+        # The commit can still fail after this
+        conn.on_rollback(lambda: self._locked(lambda: self._restore(previous)))
+
+    def _restore(self, trips):
+        """Set cards' open trips from {card_id: TripRecord or None} (caller holds the flock)."""
+        ops = []
+        for card_id, record in trips.items():
+            if record is not None:
+                ops.append(["in", *record.as_list()])
+                self.trips[card_id] = record
+            elif self.trips.pop(card_id, None) is not None:
+                ops.append(["out", card_id])
+        if ops:
+            self._append(*ops)
+
+    def checkpoint(self):
+        """Write a checkpoint now and start a new journal generation."""
+        self._locked(self._checkpoint)
+
+    def __len__(self):
+        return self._locked(lambda: len(self.trips))
+
+
+active_trips = ActiveTripStore()
+
+
+# --------------------------
+# CLI
+# --------------------------
+if __name__ == "__main__":
+    # Usage: python trip_store.py [--checkpoint]
+    if "--checkpoint" in sys.argv:
+        active_trips.checkpoint()
+        print(f"✅ Checkpoint written (generation {active_trips.gen}).")
+    print(f"[🚌] {len(active_trips)} open trip(s).")
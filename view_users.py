@@ -1,12 +1,41 @@
-import sqlite3
+import sys
+import argparse
 
-conn = sqlite3.connect('transit_fare.db')
-cursor = conn.cursor()
+import db
+from replica import replica
+from money import format_rands
 
-cursor.execute("SELECT * FROM users")
-rows = cursor.fetchall()
 
-for row in rows:
-    print(f"Card ID: {row[0]}, Name: {row[1]}, Balance: R{row[2]:.2f}")
+def _print_user(row):
+    print(f"Card ID: {row['card_id']}, Name: {row['name']} {row['surname']}, "
+          f"Email: {row['email']}, Balance: {format_rands(row['balance'])}")
 
-conn.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="List riders, or search them by partial name, email or card ID")
+    parser.add_argument("query", nargs="?", help="search words (prefix match); omit to list everyone")
+    parser.add_argument("--limit", type=int, default=20, help="results per page when searching")
+    parser.add_argument("--before", type=int, default=None, help="continue after this user id (from the last page)")
+    args = parser.parse_args()
+    if args.limit < 1:
+        parser.error("--limit must be at least 1")
+
+    # Reporting reads go to the replica so they never hold back writers
+    conn = replica.connect()
+    age = replica.age()
+    print(f"(replica age: {age:.0f}s)" if age is not None else "(no replica yet: reading the live database)")
+
+    if args.query is None:
+        # Streamed from the cursor, not fetched all at once
+        for row in conn.execute("SELECT card_id, name, surname, email, balance FROM users ORDER BY id"):
+            _print_user(row)
+    else:
+        rows = db.search_users(conn, args.query, before=args.before, limit=args.limit + 1)
+        for row in rows[:args.limit]:
+            _print_user(row)
+        if not rows:
+            print("No matching riders.")
+        elif len(rows) > args.limit:
+            print(f"More results: --before {rows[args.limit - 1]['id']}", file=sys.stderr)
+
+    conn.close()